@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+#    Copyright (C) 2022  Herbert Lange <lange@ids-mannheim.de>
+#
+# Benchmarks for the hot paths of the OCFL wrapper and the FUSE interface. Synthetic
+# stores are generated for all combinations of the given parameters and the timings are
+# written as JSON
+#
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import datetime
+import statistics
+import subprocess
+import tempfile
+import logging
+from ocfl_wrapper import OCFLPY
+
+# Name and address used for all commits
+BENCHMARK_USER = "benchmark"
+BENCHMARK_ADDRESS = "mailto:benchmark@localhost"
+
+# Runs a function repeatedly and returns the statistics of its run time in seconds
+def measure(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+    return {"count": repeat,
+            "total": sum(times),
+            "min": min(times),
+            "max": max(times),
+            "mean": statistics.mean(times),
+            "median": statistics.median(times)}
+
+# Writes a file of the given size with random content into a staged object
+def write_staged_file(ocflpy, object_id, path, size, rng):
+    ocflpy.create_staged_file(object_id, path)
+    fd = ocflpy.open_staged_file(object_id, path, os.O_WRONLY)
+    try:
+        os.write(fd, rng.randbytes(size))
+    finally:
+        ocflpy.close_staged_file(object_id, fd)
+
+# Generates a synthetic store with the given number of objects, files per object, file size
+# and versions per object. The content only depends on the seed
+def generate_store(root, staging, objects, files, file_size, versions, seed):
+    rng = random.Random(seed)
+    ocflpy = OCFLPY(root, staging, disposition='pairtree')
+    for o in range(objects):
+        object_id = "object-" + str(o)
+        ocflpy.create_object(object_id)
+        ocflpy.make_staged_dir(object_id, "data")
+        for f in range(files):
+            write_staged_file(ocflpy, object_id, "data/file-" + str(f), file_size, rng)
+        ocflpy.commit_object(object_id, BENCHMARK_USER, BENCHMARK_ADDRESS)
+        # Each further version changes one file
+        for v in range(1, versions):
+            path = "data/file-" + str(v % files)
+            fd = ocflpy.open_staged_file(object_id, path, os.O_WRONLY | os.O_TRUNC)
+            try:
+                os.write(fd, rng.randbytes(file_size))
+            finally:
+                ocflpy.close_staged_file(object_id, fd)
+            ocflpy.commit_object(object_id, BENCHMARK_USER, BENCHMARK_ADDRESS)
+        ocflpy.revert_object(object_id)
+    ocflpy.shutdown()
+
+# Benchmarks the wrapper methods directly
+def benchmark_wrapper(root, staging, objects, files, file_size, repeat):
+    results = {}
+    ocflpy = OCFLPY(root, staging, disposition='pairtree')
+    object_ids = ["object-" + str(o % objects) for o in range(repeat)]
+    file_paths = ["data/file-" + str(f % files) for f in range(repeat)]
+    data = b'x' * file_size
+    # Staging an object, reverted each time so it is staged again
+    def open_object(i):
+        ocflpy.open_object(object_ids[i])
+        ocflpy.revert_object(object_ids[i])
+    results["open_object"] = measure(open_object, repeat)
+    ocflpy.open_object(object_ids[0])
+    results["getattr"] = measure(lambda i: ocflpy.stat_staged_path(object_ids[0], file_paths[i]), repeat)
+    results["readdir"] = measure(lambda i: ocflpy.list_staged_dir(object_ids[0], "data"), repeat)
+    def read(i):
+        with open(ocflpy.get_read_path(object_ids[0], file_paths[i]), "rb") as f:
+            f.read()
+    results["read"] = measure(read, repeat)
+    def write(i):
+        fd = ocflpy.open_staged_file(object_ids[0], file_paths[i], os.O_WRONLY | os.O_TRUNC)
+        try:
+            os.write(fd, data)
+        finally:
+            ocflpy.close_staged_file(object_ids[0], fd)
+    results["write"] = measure(write, repeat)
+    # Each commit changes one file before
+    def commit_object(i):
+        ocflpy.commit_object(object_ids[0], BENCHMARK_USER, BENCHMARK_ADDRESS)
+        write(i)
+    results["commit_object"] = measure(commit_object, repeat)
+    ocflpy.revert_object(object_ids[0])
+    ocflpy.shutdown()
+    return results
+
+# Mounts the store using the FUSE script and waits for the mount to appear
+def mount(fuse_script, root, staging, mount_point):
+    process = subprocess.Popen([sys.executable, fuse_script,
+                                "-o", "ocfl_root=" + root, "-o", "staging_directory=" + staging,
+                                mount_point, "-f"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(100):
+        if os.path.ismount(mount_point):
+            return process
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mounting " + root + " on " + mount_point + " failed")
+
+# Unmounts the store and waits for the FUSE process to finish
+def unmount(process, mount_point):
+    try:
+        subprocess.run(["fusermount", "-u", mount_point], check=False)
+    except FileNotFoundError:
+        # Without fusermount, e.g. when running as root
+        subprocess.run(["umount", mount_point], check=False)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+# Waits until the last commit of an object mounted in object_dir is finished
+def wait_for_commit(object_dir):
+    while True:
+        with open(os.path.join(object_dir, "status"), "r") as f:
+            status = f.read()
+        if "done" in status or "error" in status:
+            return status
+        time.sleep(0.01)
+
+# Benchmarks the file system operations on a mounted store
+def benchmark_fuse(fuse_script, root, staging, mount_point, objects, files, file_size, repeat):
+    results = {}
+    process = mount(fuse_script, root, staging, mount_point)
+    try:
+        object_dirs = [os.path.join(mount_point, "objects", "object-" + str(o % objects)) for o in range(repeat)]
+        file_names = ["file-" + str(f % files) for f in range(repeat)]
+        data = b'x' * file_size
+        results["readdir_objects"] = measure(lambda i: os.listdir(os.path.join(mount_point, "objects")), repeat)
+        # The first access to an object stages it
+        results["open_object"] = measure(lambda i: os.listdir(object_dirs[i]), min(repeat, objects))
+        object_dir = object_dirs[0]
+        results["getattr"] = measure(lambda i: os.stat(os.path.join(object_dir, "data", file_names[i])), repeat)
+        results["readdir"] = measure(lambda i: os.listdir(os.path.join(object_dir, "data")), repeat)
+        def read(i):
+            with open(os.path.join(object_dir, "data", file_names[i]), "rb") as f:
+                f.read()
+        results["read"] = measure(read, repeat)
+        def write(i):
+            with open(os.path.join(object_dir, "data", file_names[i]), "wb") as f:
+                f.write(data)
+        results["write"] = measure(write, repeat)
+        # Each commit changes one file before and waits for the commit to finish
+        def commit_object(i):
+            with open(os.path.join(object_dir, "commit"), "rb") as f:
+                f.read()
+            wait_for_commit(object_dir)
+            write(i)
+        results["commit_object"] = measure(commit_object, repeat)
+    finally:
+        unmount(process, mount_point)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OCFL wrapper and the FUSE interface")
+    parser.add_argument("--objects", type=int, nargs="+", default=[10, 100],
+                        help="numbers of objects in the generated stores")
+    parser.add_argument("--files", type=int, nargs="+", default=[10],
+                        help="numbers of files per object")
+    parser.add_argument("--file-size", type=int, nargs="+", default=[4096],
+                        help="sizes of the generated files in bytes")
+    parser.add_argument("--versions", type=int, nargs="+", default=[1],
+                        help="numbers of versions per object")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of times each operation is measured")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the generated content")
+    parser.add_argument("--fuse", action="store_true",
+                        help="also measure the operations on a mounted store")
+    parser.add_argument("--fuse-script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocfl-fuse.py"),
+                        help="the FUSE script to mount the stores with")
+    parser.add_argument("--work-dir",
+                        help="directory for the generated stores [default: a temporary directory]")
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to [default: standard output]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="ocfl-benchmark-")
+    results = []
+    try:
+        for objects in args.objects:
+            for files in args.files:
+                for file_size in args.file_size:
+                    for versions in args.versions:
+                        parameters = {"objects": objects, "files": files, "file_size": file_size, "versions": versions}
+                        print("Benchmarking " + json.dumps(parameters), file=sys.stderr)
+                        case_dir = os.path.join(work_dir, "-".join(str(p) for p in parameters.values()))
+                        root = os.path.join(case_dir, "store")
+                        staging = os.path.join(case_dir, "staging")
+                        os.makedirs(case_dir, exist_ok=True)
+                        start = time.perf_counter()
+                        generate_store(root, staging, objects, files, file_size, versions, args.seed)
+                        results.append({"parameters": parameters, "mode": "generate",
+                                        "operations": {"generate_store": {"count": 1, "total": time.perf_counter() - start}}})
+                        results.append({"parameters": parameters, "mode": "wrapper",
+                                        "operations": benchmark_wrapper(root, staging, objects, files, file_size, args.repeat)})
+                        if args.fuse:
+                            mount_point = os.path.join(case_dir, "mnt")
+                            os.makedirs(mount_point, exist_ok=True)
+                            results.append({"parameters": parameters, "mode": "fuse",
+                                            "operations": benchmark_fuse(args.fuse_script, root, os.path.join(case_dir, "fuse-staging"),
+                                                                         mount_point, objects, files, file_size, args.repeat)})
+                        shutil.rmtree(case_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {"timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "repeat": args.repeat,
+              "seed": args.seed,
+              "results": results}
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
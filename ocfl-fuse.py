@@ -10,9 +10,14 @@
 import os, stat, errno
 import fuse
 from fuse import Fuse
-from ocfl_wrapper import OCFLPY
-import shutil
+from ocfl_wrapper import OCFLPY, ShardedOCFLPY, timed
 import logging
+import threading
+import time
+import collections
+import itertools
+import json
+import datetime
 
 if not hasattr(fuse, '__version__'):
     raise RuntimeError("your fuse-py doesn't know of fuse.__version__, probably it's too old.")
@@ -32,6 +37,137 @@ class MyStat(fuse.Stat):
         self.st_mtime = 0
         self.st_ctime = 0
 
+# Handle of an open file in a staged object, keeps the OS file descriptor between FUSE calls
+class OCFLFileHandle():
+    def __init__(self, fd, object_id, path, content_key=None, content_path=None, write_buffer=None):
+        self.fd = fd
+        self.object_id = object_id
+        self.path = path
+        # Files read from the store are read through the block cache using the content key
+        self.content_key = content_key
+        self.content_path = content_path
+        # Offset following the last read to detect sequential reads
+        self.next_offset = 0
+        # Files opened for writing collect small writes in a write-back buffer
+        self.write_buffer = write_buffer
+
+# Handle of the ingest control file, collects the object ids written to it
+class IngestHandle():
+    def __init__(self):
+        self.data = bytearray()
+
+# Handle of the revert file opened for writing, the object is reverted when it is closed
+class RevertHandle():
+    def __init__(self, object_id):
+        self.object_id = object_id
+        self.reverted = False
+
+# Handle of the statistics file, keeps the content from the time it was opened. The content
+# can be larger than the size reported before, so it bypasses the page cache
+class StatsHandle():
+    def __init__(self, data):
+        self.data = data
+        self.direct_io = True
+
+# Cache of file attributes and directory entries. Entries expire after a timeout and are
+# invalidated by all operations changing the file system
+class AttrCache():
+    def __init__(self, timeout, max_size=100000):
+        self.timeout = timeout
+        self.max_size = max_size
+        # Maps from path to a tuple of the expiry time, the cached value and the generation it
+        # was cached in
+        self.attrs = collections.OrderedDict()
+        self.entries = collections.OrderedDict()
+        # Paths invalidated with everything below them, mapped to the generation and the time of
+        # the invalidation. Entries cached in an earlier generation below such a path are stale,
+        # so invalidating a tree does not have to scan the caches
+        self.invalidated = collections.OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Looks up a path in one of the caches
+    def get(self, cache, path):
+        with self.lock:
+            entry = cache.get(path)
+            if entry is not None and entry[0] > time.monotonic() and not self.is_invalidated(path, entry[2]):
+                cache.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    # Adds a value to one of the caches
+    def put(self, cache, path, value):
+        if self.timeout <= 0:
+            return
+        with self.lock:
+            self.generation += 1
+            cache[path] = (time.monotonic() + self.timeout, value, self.generation)
+            cache.move_to_end(path)
+            if len(cache) > self.max_size:
+                cache.popitem(last=False)
+
+    def get_attr(self, path):
+        return self.get(self.attrs, path)
+
+    def put_attr(self, path, st):
+        self.put(self.attrs, path, st)
+
+    def get_entries(self, path):
+        return self.get(self.entries, path)
+
+    def put_entries(self, path, names):
+        self.put(self.entries, path, names)
+
+    # Invalidates the attributes of a path
+    def invalidate_attr(self, path):
+        with self.lock:
+            self.attrs.pop(path, None)
+
+    # Invalidates a path that was created, changed or removed, including the entries of its parent
+    def invalidate(self, path):
+        with self.lock:
+            self.attrs.pop(path, None)
+            self.entries.pop(path, None)
+            self.entries.pop(os.path.dirname(path), None)
+
+    # Checks if a path or one of its parents was invalidated after an entry was cached
+    def is_invalidated(self, path, generation):
+        if not self.invalidated:
+            return False
+        while True:
+            invalidated = self.invalidated.get(path)
+            if invalidated is not None and invalidated[0] > generation:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    # Invalidates a path and everything below it
+    def invalidate_tree(self, path):
+        if self.timeout <= 0:
+            return
+        with self.lock:
+            self.generation += 1
+            now = time.monotonic()
+            self.invalidated.pop(path, None)
+            self.invalidated[path] = (self.generation, now)
+            # Entries cached before the oldest invalidations have expired by now
+            while next(iter(self.invalidated.values()))[1] + self.timeout < now:
+                self.invalidated.popitem(last=False)
+            self.entries.pop(os.path.dirname(path), None)
+
+    # Returns the number of cache hits and misses
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.attrs) + len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
 class OCFLFS(Fuse):
 
     def __init__(self, *args, **kw):
@@ -39,44 +175,148 @@ class OCFLFS(Fuse):
         self.root = "."
         # The main folder
         self.object_path = "/objects"
-        # Keep track of the current project id
-        self.current_object_id = ""
-        self.new_objects = []
+        # Read-only view of all versions of the stored objects
+        self.version_path = "/versions"
+        # Control file to commit many staged objects at once
+        self.ingest_file = "/ingest"
+        # Report of the store-wide deduplication if it is enabled
+        self.dedup_file = "/dedup"
+        # Statistics about all operations
+        self.stats_file = "/.stats"
+        # Outcome of the validation of the store if it is enabled
+        self.validation_file = "/validation"
+        # Progress and findings of the fixity check if it is enabled
+        self.fixity_file = "/fixity"
+        # Virtual files in each object to commit or revert the staged changes and to show the
+        # status of the last commit
+        self.virtual_files = ["commit", "revert", "status"]
+        # Defaults for the mount options
+        self.index_file = None
+        self.check_index = False
+        self.eager_staging = False
+        self.digest_workers = None
+        self.digest_processes = False
+        self.inventory_cache_size = 128
+        self.inventory_cache_sidecar = False
+        self.attr_cache_timeout = 1.0
+        self.commit_workers = 1
+        self.block_cache_size = 64
+        self.block_size = 128
+        self.read_ahead = 4
+        self.dedup_index = None
+        self.stats_dump = None
+        self.stats_interval = 60.0
+        self.validate = False
+        self.write_buffer_size = 1024
+        self.write_buffer_limit = 64
+        self.sync_commits = False
+        self.fixity_state = None
+        self.fixity_rate = 10
+        self.fixity_workers = 2
+        self.fixity_interval = 24.0
+        self.shard_rule = "hash"
+        self.shard_prefixes = None
 
     # FUSE methods
+
+    # Called once the file system is mounted
+    def fsinit(self):
+        # Threads do not survive daemonizing, so indexing is only started now
+        self.ocflpy.start()
+        # Dump the statistics periodically if requested
+        if self.stats_dump is not None:
+            threading.Thread(target=self.dump_stats_periodically, daemon=True).start()
     
     # int(* 	getattr )(const char *, struct stat *, struct fuse_file_info *fi)
+    @timed("fuse.getattr")
     def getattr(self, path):
-        logging.info("GETATTR: " + path)
+        logging.info("GETATTR: %s", path)
+        # The statistics and the status of the checks change all the time and are never cached
+        if path in [self.stats_file, self.validation_file, self.fixity_file]:
+            return self.get_stat(path)
+        st = self.attr_cache.get_attr(path)
+        if st is None:
+            st = self.get_stat(path)
+            if isinstance(st, MyStat):
+                self.attr_cache.put_attr(path, st)
+        return st
+
+    # Computes the attributes of a path
+    def get_stat(self, path):
         st = MyStat()
         # Split the path
         split_path=os.path.split(path)
+        # Look up files and folders in staged objects, the objects themselves are not staged
+        object_id, file_path = self.split_object_path(path)
+        staged_stat=None
+        if object_id is not None and file_path != "":
+            object_id, file_path = self.get_staged_object_path(path)
+            if object_id is not None and file_path not in self.virtual_files:
+                staged_stat=self.ocflpy.stat_staged_path(object_id,file_path)
+        # Look up objects, versions and files in the version tree
+        version_stat=self.stat_version_path(path)
         # Root of our OCFL store
         if path == '/':
             st.st_mode = stat.S_IFDIR | 0o755
             st.st_nlink = 2
-        # The object path
-        elif path == self.object_path:
+        # The object path and the version path
+        elif path == self.object_path or path == self.version_path:
             st.st_mode = stat.S_IFDIR | 0o755
             st.st_nlink = 2
-        # Path of a staged object
-        elif split_path[0] == self.object_path and self.ocflpy.decode_id(split_path[1]) in self.ocflpy.list_object_ids() + self.new_objects:
+        # The ingest control file showing the outcome of the last ingest
+        elif path == self.ingest_file:
+            st.st_mode = stat.S_IFREG | 0o644
+            st.st_nlink = 1
+            st.st_size = len(self.get_ingest_report())
+        # The statistics
+        elif path == self.stats_file:
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = len(self.get_stats_report())
+        # The validation status
+        elif path == self.validation_file and self.ocflpy.get_validation_status() is not None:
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = len(self.get_validation_report())
+        # The progress of the fixity check
+        elif path == self.fixity_file and self.ocflpy.get_fixity_status() is not None:
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = len(self.get_fixity_report())
+        # The deduplication report
+        elif path == self.dedup_file and self.ocflpy.dedup_stats() is not None:
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = len(self.get_dedup_report())
+        # Read-only folders in the version tree
+        elif version_stat is not None and version_stat[0]:
+            st.st_mode = stat.S_IFDIR | 0o555
+            st.st_nlink = 2
+            st.st_mtime = version_stat[2]
+        # Read-only files in the version tree
+        elif version_stat is not None:
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = version_stat[1]
+            st.st_mtime = version_stat[2]
+        # Path of an object
+        elif split_path[0] == self.object_path and self.is_object(self.ocflpy.decode_id(split_path[1])):
             st.st_mode = stat.S_IFDIR | 0o755
             st.st_nlink = 2
-        # Folders in the current object
-        elif self.is_staged_object_dir(path):
+        # Folders in a staged object
+        elif staged_stat is not None and staged_stat[0]:
             st.st_mode = stat.S_IFDIR | 0o755
             st.st_nlink = 2
-            st.st_size = os.path.getsize(self.get_staged_object_path(path))
-            st.st_mtime= os.path.getmtime(self.get_staged_object_path(path))
-        # Files in the current object
-        elif self.is_staged_object_file(path):
+            st.st_size = staged_stat[1]
+            st.st_mtime= staged_stat[2]
+        # Files in a staged object
+        elif staged_stat is not None:
             st.st_mode = stat.S_IFREG | 0o755
             st.st_nlink = 1
-            st.st_size = os.path.getsize(self.get_staged_object_path(path))
-            st.st_mtime= os.path.getmtime(self.get_staged_object_path(path))
-        # Virtual file for commit
-        elif path.endswith("commit"):
+            st.st_size = staged_stat[1]
+            st.st_mtime= staged_stat[2]
+        # Virtual files for commit and revert
+        elif object_id is not None and file_path in self.virtual_files:
             st.st_mode = stat.S_IFREG | 0o755
             st.st_nlink = 1
             st.st_size = 255
@@ -87,17 +327,18 @@ class OCFLFS(Fuse):
     
     # # int(* 	readlink )(const char *, char *, size_t)
     # def readlink(self, path):
-    #     logging.info("READLINK: " + path)
+    #     logging.info("READLINK: %s", path)
     #     return 0
     
     # # int(* 	mknod )(const char *, mode_t, dev_t)
     # def mknod(self, path, mode, dev):
-    #     logging.info("MKNOD: " + path)
+    #     logging.info("MKNOD: %s", path)
     #     return 0
 
     # int(* 	mkdir )(const char *, mode_t)
+    @timed("fuse.mkdir")
     def mkdir(self, path,mode):
-        logging.info("MKDIR: " + path)
+        logging.info("MKDIR: %s", path)
         # Not in object directory or any subdirectories
         if not path.startswith(self.object_path):
             return -errno.EROFS
@@ -106,315 +347,605 @@ class OCFLFS(Fuse):
             # New object
             if split_path[0] == self.object_path and split_path[1] != "":
                 object_id=self.ocflpy.decode_id(split_path[1])
-                self.new_objects.append(object_id)
+                if self.is_object(object_id):
+                    return -errno.EEXIST
                 self.ocflpy.create_object(object_id)
+                self.attr_cache.invalidate(path)
             # New folder in staged object
-            elif self.current_object_id != "" \
-                 and self.is_staged_object_path(path) and \
-                 not os.path.exists(self.get_staged_object_path(path)):
-                os.mkdir(self.get_staged_object_path(path))
+            elif self.get_staged_object_path(path)[0] is not None:
+                object_id, file_path = self.get_staged_object_path(path)
+                self.ocflpy.make_staged_dir(object_id,file_path)
+                self.attr_cache.invalidate(path)
             else:
                 return -errno.ENOENT
         return 0
     
     # int(* 	unlink )(const char *)
+    @timed("fuse.unlink")
     def unlink(self, path):
-        logging.info("UNLINK: " + path)
-        split_path=os.path.split(path)
-        if path.startswith(self.object_path) and split_path[0] != self.object_path:
-            os.remove(self.get_staged_object_path(path))
+        logging.info("UNLINK: %s", path)
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None or file_path == "":
+            return -errno.EACCES
+        self.ocflpy.remove_staged_file(object_id,file_path)
+        self.attr_cache.invalidate(path)
         return 0
     
     # int(* 	rmdir )(const char *)
+    @timed("fuse.rmdir")
     def rmdir(self, path):
-        logging.info("RMDIR: " + path)
-        split_path=os.path.split(path)
-        if path.startswith(self.object_path) and split_path[0] != self.object_path:
-            os.removedirs(self.get_staged_object_path(path))
+        logging.info("RMDIR: %s", path)
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None or file_path == "":
+            return -errno.EACCES
+        self.ocflpy.remove_staged_dir(object_id,file_path)
+        self.attr_cache.invalidate_tree(path)
         return 0
     
     # # int(* 	symlink )(const char *, const char *)
     # def symlink(self, target, path):
-    #     logging.info("SYMLINK: " + path)
+    #     logging.info("SYMLINK: %s", path)
     #     return 0
     
     # int(* 	rename )(const char *, const char *, unsigned int flags)
+    @timed("fuse.rename")
     def rename(self, oldpath, path):
-        logging.info("RENAME: " + oldpath + " TO " + path + " BY RENAMING " + self.get_staged_object_path(oldpath) + " INTO " + self.get_staged_object_path(path))
-        os.rename(self.get_staged_object_path(oldpath),self.get_staged_object_path(path))
+        logging.info("RENAME: %s TO %s", oldpath, path)
+        old_object_id, old_file_path = self.get_staged_object_path(oldpath)
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None or old_file_path == "" or file_path == "":
+            return -errno.EACCES
+        # Files can only be moved within one object
+        if object_id != old_object_id:
+            return -errno.EXDEV
+        self.ocflpy.rename_staged_path(object_id,old_file_path,file_path)
+        self.attr_cache.invalidate_tree(oldpath)
+        self.attr_cache.invalidate_tree(path)
         return 0
     
     # # int(* 	link )(const char *, const char *)
     # def link(self, oldpath, path):
-    #     logging.info("LINK: " + path)
+    #     logging.info("LINK: %s", path)
     #     return 0
     
     # int(* 	chmod )(const char *, mode_t, struct fuse_file_info *fi)
+    @timed("fuse.chmod")
     def chmod(self, path, mode):
-        logging.info("CHMOD: " + path)
+        logging.info("CHMOD: %s", path)
         return 0
     
     # int(* 	chown )(const char *, uid_t, gid_t, struct fuse_file_info *fi)
+    @timed("fuse.chown")
     def chown(self, path, user, group):
-        logging.info("CHOWN: " + path)
+        logging.info("CHOWN: %s", path)
         return 0
     
     # int(* 	truncate )(const char *, off_t, struct fuse_file_info *fi)
+    @timed("fuse.truncate")
     def truncate(self, path, length):
-        logging.info("TRUNCATE: " + path)
-        object_file_path=self.get_staged_object_path(path)
-        f = open(object_file_path,'wb')
-        f.truncate(length)
-        f.close()
+        logging.info("TRUNCATE: %s", path)
+        if path == self.ingest_file:
+            return 0
+        object_id, file_path = self.split_object_path(path)
+        # Writing to a virtual file, e.g. echo > revert, truncates it first
+        if object_id is not None and file_path in self.virtual_files:
+            return 0
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None:
+            return -errno.ENOENT
+        # Buffered writes must not extend the file again later
+        self.ocflpy.flush_write_buffers(object_id)
+        self.ocflpy.truncate_staged_file(object_id,file_path,length)
+        self.attr_cache.invalidate_attr(path)
         return 0
     
     # int(* 	open )(const char *, struct fuse_file_info *)
+    @timed("fuse.open")
     def open(self, path, flags):
-        logging.info("OPEN: " + path)
+        logging.info("OPEN: %s", path)
         # Object path or 
         # One of the objects or
         # One of the folders in the current objects or
         # One of the files in the current object
-        if path.endswith("/commit"):
-            object_id=self.current_object_id
-            username = os.getlogin()
-            hostname = os.uname()[1] # Probably problematic on windows
-            self.ocflpy.commit_object(object_id,name=username,address="mailto:" + username + "@" + hostname)
-            if object_id in self.new_objects:
-                self.new_objects.remove(object_id)
+        accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+        # Object ids written to the ingest file are committed when it is closed
+        if path == self.ingest_file:
+            if (flags & accmode) != os.O_RDONLY:
+                return IngestHandle()
+            return 0
+        if path == self.stats_file:
+            if (flags & accmode) != os.O_RDONLY:
+                return -errno.EACCES
+            return StatsHandle(self.get_stats_report())
+        if path == self.validation_file and self.ocflpy.get_validation_status() is not None:
+            if (flags & accmode) != os.O_RDONLY:
+                return -errno.EACCES
+            return StatsHandle(self.get_validation_report())
+        if path == self.fixity_file and self.ocflpy.get_fixity_status() is not None:
+            if (flags & accmode) != os.O_RDONLY:
+                return -errno.EACCES
+            return StatsHandle(self.get_fixity_report())
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is not None and file_path == "commit":
+            username, address = self.get_creator()
+            # The commit runs in the background and its progress is shown in the status file
+            self.ocflpy.queue_commit(object_id,name=username,address=address,callback=self.commit_finished)
             return 0
+        elif object_id is not None and file_path == "revert":
+            # Only writing to the revert file (e.g. echo > revert) discards the changes
+            if (flags & accmode) == os.O_RDONLY:
+                return 0
+            if self.ocflpy.is_committing(object_id):
+                return -errno.EBUSY
+            return RevertHandle(object_id)
+        # Files in the version tree are read directly from the stored content
+        version_stat = self.stat_version_path(path)
+        if version_stat is not None:
+            if (flags & accmode) != os.O_RDONLY:
+                return -errno.EROFS
+            if version_stat[0]:
+                return 0
+            version_object_id, version, version_file_path = self.split_version_path(path)
+            content_key, content_path = self.ocflpy.get_version_stored_content(version_object_id,version,version_file_path)
+            fd=os.open(content_path,os.O_RDONLY)
+            return OCFLFileHandle(fd,version_object_id,version_file_path,content_key,content_path)
+        if self.is_staged_object_file(path):
+            # Unchanged files opened for reading are read from the store
+            if (flags & accmode) == os.O_RDONLY:
+                content_key, content_path = self.ocflpy.get_stored_content(object_id,file_path)
+                if content_key is not None:
+                    fd=os.open(content_path,os.O_RDONLY)
+                    return OCFLFileHandle(fd,object_id,file_path,content_key,content_path)
+            # Files opened for writing are copied into staging first
+            fd=self.ocflpy.open_staged_file(object_id,file_path,flags)
+            self.attr_cache.invalidate_attr(path)
+            write_buffer = None
+            if (flags & accmode) != os.O_RDONLY:
+                write_buffer = self.ocflpy.open_write_buffer(object_id,fd,file_path)
+            return OCFLFileHandle(fd,object_id,file_path,write_buffer=write_buffer)
         elif path == self.object_path or \
             os.path.split(path)[0] == self.object_path or \
-            self.is_staged_object_file(path) or \
             self.is_staged_object_dir(path):
             return 0
-        accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
         if (flags & accmode) != os.O_RDONLY:
             return -errno.EACCES
 
     # int(* 	read )(const char *, char *, size_t, off_t, struct fuse_file_info *)
-    def read(self, path, size, offset):
-        logging.info("READ: " + path + " SIZE: " + str(size) + " OFFSET: " + str(offset))
+    @timed("fuse.read")
+    def read(self, path, size, offset, fh=None):
+        logging.info("READ: %s SIZE: %s OFFSET: %s", path, size, offset)
         # Read one of the project files
-        if self.is_staged_object_file(path):
-            object_file_path=self.get_staged_object_path(path)
-            f = open(object_file_path, 'rb')
-            f.seek(offset)
-            data = f.read(size)
-            f.close()
+        if isinstance(fh, OCFLFileHandle) and fh.content_key is not None:
+            data = self.ocflpy.read_stored_content(fh.content_key, fh.content_path, fh.fd, size, offset,
+                                                   sequential=offset == fh.next_offset)
+            fh.next_offset = offset + len(data)
+            self.metrics.add("bytes_read", len(data))
             return data
-        elif path.endswith("/commit"):
-            version = self.ocflpy.get_object_inventory(self.current_object_id)['head']
-            return b'Committing object ' + bytes(self.current_object_id,'utf-8') + b'. New version ' + bytes(version, 'utf-8') + b'\n'
+        if isinstance(fh, OCFLFileHandle):
+            # Buffered writes of all handles of the object have to be visible
+            self.ocflpy.flush_write_buffers(fh.object_id)
+            data = os.pread(fh.fd, size, offset)
+            self.metrics.add("bytes_read", len(data))
+            return data
+        if isinstance(fh, StatsHandle):
+            return fh.data[offset:offset + size]
+        if path == self.ingest_file:
+            return self.get_ingest_report()[offset:offset + size]
+        if path == self.dedup_file and self.ocflpy.dedup_stats() is not None:
+            return self.get_dedup_report()[offset:offset + size]
+        object_id, file_path = self.split_object_path(path)
+        if file_path == "commit" or file_path == "status":
+            status = self.ocflpy.get_commit_status(object_id)
+            if status is None:
+                status = "not committed"
+            data = b'Commit of object ' + bytes(object_id,'utf-8') + b': ' + bytes(status,'utf-8') + b'\n'
+            return data[offset:offset + size]
+        elif file_path == "revert":
+            data = b'Write to this file to revert object ' + bytes(object_id,'utf-8') + b'\n'
+            return data[offset:offset + size]
         return -errno.ENOENT
     
     # int(* 	write )(const char *, const char *, size_t, off_t, struct fuse_file_info *)
-    def write(self, path, data, offset): # length):
-        logging.info("WRITE: " + path)
-        object_file_path=self.get_staged_object_path(path)
-        f = open(object_file_path, 'wb')
-        # f.seek(offset)
-        len = f.write(data)
-        f.close()
-        return len
+    @timed("fuse.write")
+    def write(self, path, data, offset, fh=None):
+        logging.info("WRITE: %s", path)
+        if isinstance(fh, IngestHandle):
+            fh.data[offset:offset + len(data)] = data
+            return len(data)
+        # The data written to the revert file does not matter
+        if isinstance(fh, RevertHandle):
+            return len(data)
+        if not isinstance(fh, OCFLFileHandle):
+            return -errno.EBADF
+        self.attr_cache.invalidate_attr(path)
+        if fh.write_buffer is not None:
+            written = self.ocflpy.write_buffered(fh.write_buffer, data, offset)
+        else:
+            written = os.pwrite(fh.fd, data, offset)
+        self.metrics.add("bytes_written", written)
+        return written
     
     # # int(* 	statfs )(const char *, struct statvfs *)
     # def statfs(self, path):
-    #     logging.info("STATFS: " + path)
+    #     logging.info("STATFS: %s", path)
     #     return 0
     
     # int(* 	flush )(const char *, struct fuse_file_info *)
-    def flush(self, path):
-        logging.info("FLUSH: " + path)
+    @timed("fuse.flush")
+    def flush(self, path, fh=None):
+        logging.info("FLUSH: %s", path)
+        if isinstance(fh, OCFLFileHandle) and fh.write_buffer is not None:
+            fh.write_buffer.flush()
+        # Unlike release, flush finishes before close returns, so the object is reverted by then
+        elif isinstance(fh, RevertHandle):
+            self.revert(path, fh)
         return 0
         
     # int(* 	release )(const char *, struct fuse_file_info *)
-    def release(self, path,file_info):
-        logging.info("RELEASE: " + path)
+    @timed("fuse.release")
+    def release(self, path, flags, fh=None):
+        logging.info("RELEASE: %s", path)
+        if isinstance(fh, OCFLFileHandle):
+            try:
+                if fh.write_buffer is not None:
+                    self.ocflpy.close_write_buffer(fh.write_buffer)
+            finally:
+                if fh.content_key is None:
+                    self.ocflpy.close_staged_file(fh.object_id, fh.fd)
+                else:
+                    os.close(fh.fd)
+                self.attr_cache.invalidate_attr(path)
+        # Ingest all objects listed in the ingest file, a single * selects all new objects
+        elif isinstance(fh, IngestHandle):
+            ids = [line.strip() for line in fh.data.decode('utf-8').splitlines() if line.strip() != ""]
+            if "*" in ids:
+                ids = self.ocflpy.list_new_object_ids()
+            if ids:
+                username, address = self.get_creator()
+                self.ocflpy.queue_ingest(ids,name=username,address=address,callback=self.ingest_finished)
+        # Discard all changes once the revert file is closed
+        elif isinstance(fh, RevertHandle):
+            self.revert(path, fh)
         return 0
+
+    # Discards all changes of the object of a revert handle once
+    def revert(self, path, fh):
+        if not fh.reverted:
+            fh.reverted = True
+            self.ocflpy.revert_object(fh.object_id)
+            self.attr_cache.invalidate_tree(os.path.dirname(path))
     
-    # # int(* 	fsync )(const char *, int, struct fuse_file_info *)
-    # def fsync(self, path):
-    #     logging.info("FSYNC: " + path)
-    #     return 0
+    # int(* 	fsync )(const char *, int, struct fuse_file_info *)
+    @timed("fuse.fsync")
+    def fsync(self, path, datasync, fh=None):
+        logging.info("FSYNC: %s", path)
+        if isinstance(fh, OCFLFileHandle):
+            if fh.write_buffer is not None:
+                fh.write_buffer.flush()
+            if datasync:
+                os.fdatasync(fh.fd)
+            else:
+                os.fsync(fh.fd)
+        return 0
+
+    # int(* 	ftruncate )(const char *, off_t, struct fuse_file_info *)
+    @timed("fuse.ftruncate")
+    def ftruncate(self, path, length, fh=None):
+        logging.info("FTRUNCATE: %s", path)
+        if not isinstance(fh, OCFLFileHandle):
+            return self.truncate(path, length)
+        if fh.write_buffer is not None:
+            fh.write_buffer.flush()
+        os.ftruncate(fh.fd, length)
+        self.attr_cache.invalidate_attr(path)
+        return 0
     
     # # int(* 	setxattr )(const char *, const char *, const char *, size_t, int)
     # def setxattr(self, path):
-    #     logging.info("SETXATTR: " + path)
+    #     logging.info("SETXATTR: %s", path)
     #     return 0
     
     # # int(* 	getxattr )(const char *, const char *, char *, size_t)
     # def getxattr(self, path,x,y):
-    #     logging.info("GETXATTR: " + path)
+    #     logging.info("GETXATTR: %s", path)
     #     return 0
     
     # # int(* 	listxattr )(const char *, char *, size_t)
     # def listxattr(self, path):
-    #     logging.info("LISTXATTR: " + path)
+    #     logging.info("LISTXATTR: %s", path)
     #     return 0
     
     # # int(* 	removexattr )(const char *, const char *)
     # def removexattr(self, path):
-    #     logging.info("REMOVEXATTR: " + path)
+    #     logging.info("REMOVEXATTR: %s", path)
     #     return 0
     
     # # int(* 	opendir )(const char *, struct fuse_file_info *)
     # def opendir(self, path):
-    #     logging.info("OPENDIR: " + path)
+    #     logging.info("OPENDIR: %s", path)
     #     return 0
     
     # int(* 	readdir )(const char *, void *, fuse_fill_dir_t, off_t, struct fuse_file_info *, enum fuse_readdir_flags)
+    @timed("fuse.readdir")
     def readdir(self, path, offset):
-        logging.info("READDIR: " + path)
-        for r in '.', '..':
-            yield fuse.Direntry(r)
+        logging.info("READDIR: %s OFFSET: %s", path, offset)
+        # The offset of each entry is its position, so the kernel can continue a listing
+        # after the last entry it has seen
+        names = self.iter_dir(path, max(offset - 2, 0))
+        if offset < 2:
+            names = itertools.chain(['.', '..'][offset:], names)
+        for position, name in enumerate(names, start=offset + 1):
+            yield fuse.Direntry(name, offset=position)
+
+    # Iterates over the names in a directory starting at a position
+    def iter_dir(self, path, start):
+        # The object lists are streamed from the sorted index instead of being built in full
+        if path == self.object_path or path == self.version_path:
+            return map(self.ocflpy.encode_id, self.iter_object_ids(start, path == self.object_path))
+        names = self.attr_cache.get_entries(path)
+        if names is None:
+            names = self.list_dir(path)
+            self.attr_cache.put_entries(path, names)
+        return itertools.islice(names, start, None)
+
+    # Iterates over the ids of the stored objects followed by the new objects if requested
+    def iter_object_ids(self, start, new_objects):
+        stored_count = self.ocflpy.count_object_ids()
+        new_ids = self.ocflpy.list_new_object_ids() if new_objects else []
+        if start < stored_count:
+            return itertools.chain(self.ocflpy.iter_object_ids(start), new_ids)
+        return iter(new_ids[start - stored_count:])
+
+    # Lists the names in a directory
+    def list_dir(self, path):
         # Root of our OCFL store
         if path == '/':
-            for r in  [self.object_path[1:]]:
-                yield fuse.Direntry(r)
-        # The object list
-        elif path == self.object_path:
-            for oid in self.ocflpy.list_object_ids() + self.new_objects:
-                normalized_id=self.ocflpy.encode_id(oid)
-                yield fuse.Direntry(normalized_id)
-        # Listing the content of an unstaged object
-        elif path.startswith(self.object_path) and self.current_object_id == "":
-            split_path=os.path.split(path)
-            # get object id
-            object_id=split_path[1]
-            self.current_object_id=self.ocflpy.decode_id(object_id)
-            # Virtual file to trigger commit
-            yield fuse.Direntry("commit")
-            for file in os.listdir(self.ocflpy.get_staging_object_path(self.current_object_id)):
-                yield fuse.Direntry(file)
-        # Listing the content of a staged object
-        elif path == os.path.join(self.object_path,self.ocflpy.encode_id(self.current_object_id)):
-            # Virtual file to trigger commit
-            yield fuse.Direntry("commit")
-            for file in os.listdir(self.ocflpy.get_staging_object_path(self.current_object_id)):
-                yield fuse.Direntry(file)
-        elif path.startswith(os.path.join(self.object_path,self.ocflpy.encode_id(self.current_object_id))):
-            for file in os.listdir(self.get_staged_object_path(path)):
-                yield fuse.Direntry(file)
-                
+            names = [self.object_path[1:], self.version_path[1:], self.ingest_file[1:], self.stats_file[1:]]
+            if self.ocflpy.dedup_stats() is not None:
+                names.append(self.dedup_file[1:])
+            if self.ocflpy.get_validation_status() is not None:
+                names.append(self.validation_file[1:])
+            if self.ocflpy.get_fixity_status() is not None:
+                names.append(self.fixity_file[1:])
+            return names
+        # Versions of an object or folders in a version
+        elif path.startswith(self.version_path + "/"):
+            object_id, version, file_path = self.split_version_path(path)
+            version_stat = self.stat_version_path(path)
+            if version_stat is None or not version_stat[0]:
+                return []
+            if version is None:
+                return self.ocflpy.list_object_versions(object_id)
+            return self.ocflpy.list_version_dir(object_id,version,file_path)
+        # Listing the content of an object, staging it if necessary
+        elif self.is_staged_object_dir(path):
+            object_id, file_path = self.get_staged_object_path(path)
+            names = self.ocflpy.list_staged_dir(object_id,file_path)
+            # Virtual files to trigger commit and revert
+            if file_path == "":
+                names = self.virtual_files + names
+            return names
+        return []
+
     # # int(* 	releasedir )(const char *, struct fuse_file_info *)
     # def releasedir(self, path):
-    #     logging.info("RELEASEDIR: " + path)
+    #     logging.info("RELEASEDIR: %s", path)
     #     return 0
     
     # # int(* 	fsyncdir )(const char *, int, struct fuse_file_info *)
     # def fsyncdir(self, path):
-    #     logging.info("FSYNCDIR: " + path)
+    #     logging.info("FSYNCDIR: %s", path)
     #     return 0
     
     # void *(* 	init )(struct fuse_conn_info *conn, struct fuse_config *cfg)
     # void(* 	destroy )(void *private_data)
     # int(* 	access )(const char *, int)
+    @timed("fuse.access")
     def access(self, path, x):
-        logging.info("ACCESS: " + path)
-        if path == self.object_path:
-            # Revert if we change back into the object path
-            if self.current_object_id != "":
-                self.ocflpy.revert_object(self.current_object_id)
-                if self.current_object_id in self.new_objects:
-                    self.new_objects.remove(self.current_object_id)
-                self.current_object_id = ""
-        split_path=os.path.split(path)
-        # We access an (unstaged) object
-        if split_path[0] == self.object_path and split_path[1] != "":
-            object_id=split_path[1]
-            id=self.ocflpy.decode_id(object_id)
-            # Stage unstaged object if necessary
-            if self.current_object_id == "":
-                if id in self.ocflpy.list_object_ids():
-                    self.ocflpy.open_object(id)
-                self.current_object_id=self.ocflpy.decode_id(object_id)
+        logging.info("ACCESS: %s", path)
+        # Stage the object if we access an unstaged object
+        self.get_staged_object_path(path)
         return 0
     
     # int(* 	create )(const char *, mode_t, struct fuse_file_info *)
-    def create(self, path, mode ,file_info):
-        logging.info("CREATE: " + path + " - Mode: " + str(mode) + " - File Info: " + str(file_info))
-        if self.current_object_id != "":
-            logging.info("ADDING " + path)
-            # Check if file exists and otherwise create it
-            object_file_path=self.get_staged_object_path(path)
-            if not os.path.exists(object_file_path):
-                open(object_file_path,'wb').close()
-        return 0
+    @timed("fuse.create")
+    def create(self, path, flags, mode):
+        logging.info("CREATE: %s - Flags: %s - Mode: %s", path, flags, mode)
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None or file_path == "" or file_path in self.virtual_files:
+            return -errno.EACCES
+        logging.info("ADDING %s", path)
+        # Check if file exists and otherwise create it
+        self.ocflpy.create_staged_file(object_id,file_path)
+        self.attr_cache.invalidate(path)
+        fd=self.ocflpy.open_staged_file(object_id,file_path,os.O_RDWR)
+        return OCFLFileHandle(fd,object_id,file_path,write_buffer=self.ocflpy.open_write_buffer(object_id,fd,file_path))
     
     # # int(* 	lock )(const char *, struct fuse_file_info *, int cmd, struct flock *)
     # #    def lock(self, cmd,owner,**kw):
     # def lock(self, path, cmd, owner, **kw):
-    #     logging.info("LOCK: " + path)
+    #     logging.info("LOCK: %s", path)
     #     return 0
     
     # int(* 	utimens )(const char *, const struct timespec tv[2], struct fuse_file_info *fi)
+    @timed("fuse.utimens")
     def utimens(self, path,timespec,file_info):
-        logging.info("UTIMENS: " + path)
+        logging.info("UTIMENS: %s", path)
         return 0
     
     # # int(* 	bmap )(const char *, size_t blocksize, uint64_t *idx)
     # def bmap(self, path):
-    #     logging.info("BMAP: " + path)
+    #     logging.info("BMAP: %s", path)
     #     return 0
     
     # # int(* 	ioctl )(const char *, unsigned int cmd, void *arg, struct fuse_file_info *, unsigned int flags, void *data)
     # def ioctl(self, path, cmd, arg, flags):
-    #     logging.info("IOCTL: " + path)
+    #     logging.info("IOCTL: %s", path)
     #     return 0
     
     # # int(* 	poll )(const char *, struct fuse_file_info *, struct fuse_pollhandle *ph, unsigned *reventsp)
     # def poll(self, path):
-    #     logging.info("POLL: " + path)
+    #     logging.info("POLL: %s", path)
     #     return 0
     
     # # int(* 	write_buf )(const char *, struct fuse_bufvec *buf, off_t off, struct fuse_file_info *)
     # def write_buf(self, path):
-    #     logging.info("WRITE_BUF: " + path)
+    #     logging.info("WRITE_BUF: %s", path)
     #     return 0
     
     # # int(* 	read_buf )(const char *, struct fuse_bufvec **bufp, size_t size, off_t off, struct fuse_file_info *)
     # def read_buf(self, path):
-    #     logging.info("READ_BUF: " + path)
+    #     logging.info("READ_BUF: %s", path)
     #     return 0
     
     # # int(* 	flock )(const char *, struct fuse_file_info *, int op)
     # def flock(self, path):
-    #     logging.info("FLOCK: " + path)
+    #     logging.info("FLOCK: %s", path)
     #     return 0
     
     # # int(* 	fallocate )(const char *, int, off_t, off_t, struct fuse_file_info *)
     # def fallocate(self, path):
-    #     logging.info("FALLOCATE: " + path)
+    #     logging.info("FALLOCATE: %s", path)
     #     return 0
     
     # # ssize_t(* 	copy_file_range )(const char *path_in, struct fuse_file_info *fi_in, off_t offset_in, const char *path_out, struct fuse_file_info *fi_out, off_t offset_out, size_t size, int flags)
     # # off_t(* 	lseek )(const char *, off_t off, int whence, struct fuse_file_info *)
     # def lseek(self, path):
-    #     logging.info("LSEEK: " + path)
+    #     logging.info("LSEEK: %s", path)
     #     return 0    
 
     # Helper functions
 
-    # Gets the staging file name for an object file
+    # Gets the name and address used as creator of new versions
+    def get_creator(self):
+        username = os.getlogin()
+        hostname = os.uname()[1] # Probably problematic on windows
+        return username, "mailto:" + username + "@" + hostname
+
+    # Gets the content of the ingest file listing the outcome of the last ingest
+    def get_ingest_report(self):
+        results = self.ocflpy.get_ingest_results()
+        return "".join(id + ": " + results[id] + "\n" for id in sorted(results)).encode('utf-8')
+
+    # Gets the content of the statistics file
+    def get_stats_report(self):
+        stats = self.ocflpy.get_stats()
+        stats["attr_cache"] = self.attr_cache.stats()
+        return (json.dumps(stats, indent=2) + "\n").encode('utf-8')
+
+    # Writes the statistics to the dump file in regular intervals
+    def dump_stats_periodically(self):
+        while True:
+            time.sleep(self.stats_interval)
+            try:
+                tmp_file = self.stats_dump + ".tmp"
+                with open(tmp_file, "wb") as f:
+                    f.write(self.get_stats_report())
+                os.replace(tmp_file, self.stats_dump)
+            except OSError as e:
+                logging.warning("Cannot write statistics to %s: %s", self.stats_dump, e)
+
+    # Gets the content of the validation file, the status followed by all findings
+    def get_validation_report(self):
+        status, findings = self.ocflpy.get_validation_status()
+        return ("".join([status + "\n"] + [finding + "\n" for finding in findings])).encode('utf-8')
+
+    # Gets the content of the fixity file, the progress of the current pass followed by all findings
+    def get_fixity_report(self):
+        status = self.ocflpy.get_fixity_status()
+        def timestamp(t):
+            return datetime.datetime.fromtimestamp(t,datetime.timezone.utc).isoformat() if t is not None else "running"
+        lines = ["pass: " + str(status["pass"]),
+                 "started: " + timestamp(status["started"]),
+                 "finished: " + timestamp(status["finished"]),
+                 "position: " + (status["position"] if status["position"] is not None else ""),
+                 "objects checked: " + str(status["objects"]),
+                 "files checked: " + str(status["files"]),
+                 "bytes checked: " + str(status["bytes"]),
+                 "failures: " + str(status["failures"])]
+        return "".join(line + "\n" for line in lines + status["findings"]).encode('utf-8')
+
+    # Gets the content of the deduplication report
+    def get_dedup_report(self):
+        stats = self.ocflpy.dedup_stats()
+        return ("entries: " + str(stats["entries"]) + "\n" +
+                "linked files: " + str(stats["linked_files"]) + "\n" +
+                "bytes saved: " + str(stats["bytes_saved"]) + "\n").encode('utf-8')
+
+    # Called when a queued ingest is finished
+    def ingest_finished(self,object_ids):
+        for object_id in object_ids:
+            self.commit_finished(object_id)
+        self.attr_cache.invalidate_attr(self.ingest_file)
+
+    # Called when a queued commit is finished
+    def commit_finished(self,object_id):
+        self.attr_cache.invalidate_tree(self.object_path + "/" + self.ocflpy.encode_id(object_id))
+        self.attr_cache.invalidate_tree(self.version_path + "/" + self.ocflpy.encode_id(object_id))
+        self.attr_cache.invalidate_attr(self.dedup_file)
+
+    # Checks if an object id is either in the store or a new object
+    def is_object(self,id):
+        return self.ocflpy.has_object(id) or self.ocflpy.is_staged(id)
+
+    # Splits a path into the object id and the path of the file relative to the object
+    def split_object_path(self,path):
+        if not path.startswith(self.object_path + "/"):
+            return None, None
+        split_path = path[len(self.object_path) + 1:].split("/",1)
+        object_id = self.ocflpy.decode_id(split_path[0])
+        return object_id, split_path[1] if len(split_path) > 1 else ""
+
+    # Gets the object id and file path for a path in an object and stages the object if
+    # necessary. Returns None as object id if the path is not in an object
     def get_staged_object_path(self,path):
-        # Get the path of file in staging and read it
-        oid=self.current_object_id
-        file_path=path.replace(os.path.join(self.object_path,self.ocflpy.encode_id(oid)) + "/","")
-        return os.path.join(self.ocflpy.get_staging_object_path(oid),file_path)
-    
-    # Checks if a path is to a staged file/directory
-    def is_staged_object_path(self,path):
-        oid=self.current_object_id
-        return oid != "" and path.startswith(os.path.join(self.object_path,self.ocflpy.encode_id(oid)))
+        object_id, file_path = self.split_object_path(path)
+        if object_id is None:
+            return None, None
+        if not self.ocflpy.is_staged(object_id):
+            if not self.ocflpy.has_object(object_id):
+                return None, None
+            self.ocflpy.open_object(object_id)
+        return object_id, file_path
+
+    # Splits a path in the version tree into the object id, the version and the path of the
+    # file relative to the version. Returns None for all parts not in the path
+    def split_version_path(self,path):
+        if not path.startswith(self.version_path + "/"):
+            return None, None, None
+        split_path = path[len(self.version_path) + 1:].split("/",2)
+        object_id = self.ocflpy.decode_id(split_path[0])
+        if len(split_path) == 1:
+            return object_id, None, None
+        return object_id, split_path[1], split_path[2] if len(split_path) > 2 else ""
+
+    # Returns a tuple of is_dir, size and mtime for a path in the version tree or None if it
+    # does not exist. Nothing is staged
+    def stat_version_path(self,path):
+        object_id, version, file_path = self.split_version_path(path)
+        if object_id is None or not self.ocflpy.has_object(object_id):
+            return None
+        if version is None:
+            return (True, 0, 0)
+        if version not in self.ocflpy.list_object_versions(object_id):
+            return None
+        return self.ocflpy.stat_version_path(object_id,version,file_path)
 
     # Check if a path is a staged file
     def is_staged_object_file(self,path):
-        return self.is_staged_object_path(path) and os.path.isfile(self.get_staged_object_path(path))
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None or file_path in self.virtual_files:
+            return False
+        staged_stat=self.ocflpy.stat_staged_path(object_id,file_path)
+        return staged_stat is not None and not staged_stat[0]
 
     # Check if a path is a staged directory
     def is_staged_object_dir(self,path):
-        return self.is_staged_object_path(path) and os.path.isdir(self.get_staged_object_path(path))
+        object_id, file_path = self.get_staged_object_path(path)
+        if object_id is None:
+            return False
+        staged_stat=self.ocflpy.stat_staged_path(object_id,file_path)
+        return staged_stat is not None and staged_stat[0]
 
 def main():
     usage="""
@@ -425,28 +956,104 @@ Userspace ocfl client
     logging.basicConfig(level=logging.WARNING)
     server = OCFLFS(version="%prog " + fuse.__version__,
                      usage=usage,
-                     dash_s_do='whine')
+                     dash_s_do='setsingle')
+    # Objects are staged independently so requests can be handled in parallel
+    server.multithreaded = True
     server.parser.add_option(mountopt="ocfl_root", metavar="PATH",
-                             help="load OCFL root from PATH")
+                             help="load OCFL root from PATH, several roots separated by colons are mounted as one store")
     server.parser.add_option(mountopt="staging_directory", metavar="PATH",
-                             help="use PATH as staging directory")
+                             help="use PATH as staging directory, or one directory per root separated by colons")
+    server.parser.add_option(mountopt="shard_rule", metavar="RULE",
+                             help="assign new objects to a root by 'hash' of the id or by 'prefix' [default: hash]")
+    server.parser.add_option(mountopt="shard_prefixes", metavar="PREFIXES",
+                             help="id prefix of each root separated by colons for the prefix rule")
+    server.parser.add_option(mountopt="index_file", metavar="PATH",
+                             help="keep the object index in PATH between mounts")
+    server.parser.add_option(mountopt="check_index", action="store_true",
+                             help="check the object index against the store on mount")
+    server.parser.add_option(mountopt="eager_staging", action="store_true",
+                             help="extract complete objects into staging instead of copying files when they are changed")
+    server.parser.add_option(mountopt="digest_workers", metavar="N", type="int",
+                             help="compute digests in N parallel workers [default: number of CPUs]")
+    server.parser.add_option(mountopt="digest_processes", action="store_true",
+                             help="use processes instead of threads to compute digests")
+    server.parser.add_option(mountopt="inventory_cache_size", metavar="N", type="int",
+                             help="keep up to N parsed inventories in memory [default: 128]")
+    server.parser.add_option(mountopt="inventory_cache_sidecar", action="store_true",
+                             help="also check the inventory sidecar before using a cached inventory")
+    server.parser.add_option(mountopt="attr_cache_timeout", metavar="SECONDS", type="float",
+                             help="cache attributes and directory entries for SECONDS [default: 1.0]")
+    server.parser.add_option(mountopt="commit_workers", metavar="N", type="int",
+                             help="run up to N commits in the background at the same time [default: 1]")
+    server.parser.add_option(mountopt="dedup_index", metavar="PATH",
+                             help="deduplicate content across objects using the digest index in PATH")
+    server.parser.add_option(mountopt="block_cache_size", metavar="MIB", type="int",
+                             help="cache up to MIB mebibytes of content read from the store, 0 disables the cache [default: 64]")
+    server.parser.add_option(mountopt="block_size", metavar="KIB", type="int",
+                             help="size of the cached blocks in kibibytes [default: 128]")
+    server.parser.add_option(mountopt="read_ahead", metavar="N", type="int",
+                             help="read N blocks ahead on sequential reads [default: 4]")
+    server.parser.add_option(mountopt="stats_dump", metavar="PATH",
+                             help="write the statistics to PATH in regular intervals")
+    server.parser.add_option(mountopt="stats_interval", metavar="SECONDS", type="float",
+                             help="write the statistics every SECONDS [default: 60]")
+    server.parser.add_option(mountopt="write_buffer_size", metavar="KIB", type="int",
+                             help="collect small writes to a file in a buffer of KIB kibibytes, 0 disables the buffers [default: 1024]")
+    server.parser.add_option(mountopt="write_buffer_limit", metavar="MIB", type="int",
+                             help="flush write buffers when they hold more than MIB mebibytes together [default: 64]")
+    server.parser.add_option(mountopt="sync_commits", action="store_true",
+                             help="write all content and inventories to disk before a commit is finished")
+    server.parser.add_option(mountopt="fixity_state", metavar="PATH",
+                             help="check the stored content against the inventories in the background and keep the progress in PATH")
+    server.parser.add_option(mountopt="fixity_rate", metavar="MIB", type="float",
+                             help="read at most MIB mebibytes per second for the fixity check, 0 for no limit [default: 10]")
+    server.parser.add_option(mountopt="fixity_workers", metavar="N", type="int",
+                             help="check N files of an object in parallel [default: 2]")
+    server.parser.add_option(mountopt="fixity_interval", metavar="HOURS", type="float",
+                             help="start a new fixity check HOURS after the last one finished [default: 24]")
+    server.parser.add_option(mountopt="validate", action="store_true",
+                             help="validate the store and all objects in the background")
     server.parse(values=server,errex=1)
-    # Create staging directory if missing
-    if not os.path.exists(server.staging_directory):
-        os.mkdir(server.staging_directory)
+    # Create staging directories if missing
+    for staging_directory in server.staging_directory.split(os.pathsep):
+        if not os.path.exists(staging_directory):
+            os.mkdir(staging_directory)
     # Check if we already got the ocfl root or use one additional parameter
     if len(server.cmdline[1]) == 1 and not hasattr(server, "ocfl_root"):
         server.ocfl_root=server.cmdline[1][0];
     try:
         # server.store=Store(server.ocfl_root)
-        server.ocflpy = OCFLPY(server.ocfl_root,server.staging_directory,disposition='pairtree',verbose=True)
+        server.attr_cache = AttrCache(server.attr_cache_timeout)
+        options = dict(verbose=True,index_file=server.index_file,check_index=server.check_index,
+                       lazy=not server.eager_staging,
+                       digest_workers=server.digest_workers,digest_processes=server.digest_processes,
+                       inventory_cache_size=server.inventory_cache_size,
+                       inventory_cache_sidecar=server.inventory_cache_sidecar,
+                       commit_workers=server.commit_workers,dedup_index=server.dedup_index,
+                       block_cache_size=server.block_cache_size * 1024 * 1024,
+                       block_size=server.block_size * 1024,read_ahead=server.read_ahead,
+                       validate=server.validate,start=False,
+                       write_buffer_size=server.write_buffer_size * 1024,
+                       write_buffer_limit=server.write_buffer_limit * 1024 * 1024,
+                       sync_commits=server.sync_commits,fixity_state=server.fixity_state,
+                       fixity_rate=server.fixity_rate * 1024 * 1024,fixity_workers=server.fixity_workers,
+                       fixity_interval=server.fixity_interval * 60 * 60)
+        # Several roots are mounted as one store, each with its own staging directory and workers
+        roots = server.ocfl_root.split(os.pathsep)
+        if len(roots) > 1:
+            shard_prefixes = server.shard_prefixes.split(os.pathsep) if server.shard_prefixes is not None else None
+            server.ocflpy = ShardedOCFLPY(roots,server.staging_directory.split(os.pathsep),'pairtree',
+                                          shard_rule=server.shard_rule,shard_prefixes=shard_prefixes,**options)
+        else:
+            server.ocflpy = OCFLPY(server.ocfl_root,server.staging_directory,disposition='pairtree',**options)
+        server.metrics = server.ocflpy.metrics
         # server.store.validate()
     except AttributeError as e:
         print("No OCFL root or staging directory given")
         exit(-1)
     server.main()
-    # Cleanup staging directory
-    shutil.rmtree(server.staging_directory)
+    # Finish all queued commits, objects with uncommitted changes are kept in staging
+    server.ocflpy.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -7,18 +7,1201 @@ import os
 from ocfl import Store
 from ocfl import Object
 from ocfl import VersionMetadata
+from ocfl import Validator
 from ocfl.dispositor import Dispositor
+from ocfl.digest import file_digest
+from ocfl.object_utils import next_version
 import re
 import shutil
 import json
 import datetime
 import logging
+import errno
+import time
+import threading
+import hashlib
+import concurrent.futures
+import collections
+import fcntl
+import bisect
+import heapq
+import itertools
+import functools
+import inspect
+import contextlib
+import tempfile
+
+# Size of the chunks files are read in when computing digests
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+# Creates a hashlib digester for an OCFL digest algorithm or returns None if not supported by hashlib
+def new_digester(digest_algorithm):
+    if digest_algorithm in ['sha512','sha256','sha1','md5']:
+        return hashlib.new(digest_algorithm)
+    elif digest_algorithm.startswith('blake2b-'):
+        return hashlib.blake2b(digest_size=int(digest_algorithm[len('blake2b-'):]) // 8)
+    return None
+
+# Tells the kernel how a file is going to be read or that its pages are not needed anymore,
+# if the platform supports it
+def advise_file(fd,advice):
+    if hasattr(os,'posix_fadvise'):
+        os.posix_fadvise(fd,0,0,advice)
+
+# Reads a file in chunks into a buffer of fixed size and calls process for each chunk, so
+# the memory needed does not depend on the size of the file. The pages of the file are
+# dropped from the page cache afterwards because the file is read only once
+def stream_file(filename,process):
+    buffer = bytearray(DIGEST_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(filename,'rb',buffering=0) as f:
+        advise_file(f.fileno(),getattr(os,'POSIX_FADV_SEQUENTIAL',0))
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            process(view[:size])
+        advise_file(f.fileno(),getattr(os,'POSIX_FADV_DONTNEED',0))
+
+# Computes the digest of a file reading it in large chunks, optionally limiting the rate it
+# is read at. Defined on module level so it can also be run in a process pool
+def compute_digest(filename,digest_algorithm,limiter=None):
+    digester = new_digester(digest_algorithm)
+    # Leave all special cases to the ocfl implementation
+    if digester is None:
+        return file_digest(filename,digest_algorithm)
+    if limiter is None:
+        stream_file(filename,digester.update)
+    else:
+        def process(chunk):
+            limiter.consume(len(chunk))
+            digester.update(chunk)
+        stream_file(filename,process)
+    return digester.hexdigest()
+
+# Copies a file and computes its digest in the same pass, so the file is read only once.
+# Defined on module level so it can also be run in a process pool
+def copy_digest(src,dst,digest_algorithm):
+    digester = new_digester(digest_algorithm)
+    if digester is None:
+        copy_file_data(src,dst)
+        return file_digest(dst,digest_algorithm)
+    with open(dst,'wb',buffering=0) as fdst:
+        def process(chunk):
+            digester.update(chunk)
+            while chunk:
+                chunk = chunk[fdst.write(chunk):]
+        stream_file(src,process)
+    return digester.hexdigest()
+
+# ioctl sharing the data blocks of two files on file systems supporting reflinks
+FICLONE = 0x40049409
+
+# Creates a copy of a file sharing the data blocks with the source (reflink). Returns False
+# and leaves no file behind if the file system does not support it
+def reflink_file(src,dst):
+    with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+# Copies the data of a file inside the kernel using copy_file_range, which some file systems
+# turn into a server-side copy or shared blocks. Only the regions holding data are copied,
+# so sparse files stay sparse
+def copy_file_data(src,dst):
+    with open(src,'rb') as fsrc, open(dst,'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for start, end in data_extents(fsrc.fileno(),size):
+            copy_range(fsrc.fileno(),start,fdst.fileno(),start,end - start)
+        # Holes at the end of the file are not copied, so the size is set explicitly
+        os.ftruncate(fdst.fileno(),size)
+
+# Yields the start and end offsets of all regions of a file holding data, skipping the holes of
+# sparse files. The whole file is one region if the file system does not report holes
+def data_extents(fd,size):
+    if not hasattr(os,'SEEK_DATA'):
+        if size > 0:
+            yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd,offset,os.SEEK_DATA)
+        except OSError as e:
+            # No more data after offset
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            yield offset, size
+            return
+        end = min(os.lseek(fd,start,os.SEEK_HOLE),size)
+        yield start, end
+        offset = end
+
+# Copies a range of bytes between two file descriptors at explicit offsets and returns the
+# number of bytes copied. The kernel copies the data (or shares it on file systems supporting
+# reflinks) unless copy_file_range is not available for the files, then it is copied in chunks
+def copy_range(fd_in,offset_in,fd_out,offset_out,length):
+    copied = 0
+    if hasattr(os,'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(fd_in,fd_out,length - copied,offset_in + copied,offset_out + copied)
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+    while copied < length:
+        data = os.pread(fd_in,min(DIGEST_CHUNK_SIZE,length - copied),offset_in + copied)
+        if not data:
+            break
+        copied += os.pwrite(fd_out,data,offset_out + copied)
+    return copied
+
+# Copies a file sharing the data blocks with the source (reflink) if the file system
+# supports it and making a plain copy otherwise
+def clone_file(src,dst):
+    if not reflink_file(src,dst):
+        copy_file_data(src,dst)
+
+# Checks if two paths are on the same file system, i.e. files can be linked between them
+def same_file_system(path,other_path):
+    return os.stat(path).st_dev == os.stat(other_path).st_dev
+
+# Writes the data of files and the entries of directories to disk. Called once for all files
+# after they are written, so the kernel can already write them back in the meantime
+def sync_paths(paths):
+    for path in paths:
+        fd = os.open(path,os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+# Links a file into a new place without copying the data and falls back to cloning the file
+# if both are on different file systems
+def link_file(src,dst):
+    try:
+        os.link(src,dst)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        clone_file(src,dst)
+
+# Upper bounds of the buckets of the latency histograms in seconds
+LATENCY_BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1, 10]
+
+# Number of calls, cumulative run time and latency histogram for each operation as well as
+# general counters, e.g. for the number of bytes read
+class Metrics():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Map from operation to a list of the number of calls, the cumulative run time and the
+        # number of calls in each bucket of the latency histogram
+        self.operations = {}
+        self.counters = {}
+
+    # Records one call of an operation
+    def record(self,name,elapsed):
+        with self.lock:
+            operation = self.operations.get(name)
+            if operation is None:
+                operation = self.operations[name] = [0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            operation[0] += 1
+            operation[1] += elapsed
+            operation[2][bisect.bisect_left(LATENCY_BUCKETS,elapsed)] += 1
+
+    # Adds a value to a counter
+    def add(self,name,value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + value
+
+    # Returns a copy of all metrics
+    def snapshot(self):
+        bucket_names = [str(bound) for bound in LATENCY_BUCKETS] + ["inf"]
+        with self.lock:
+            operations = {name: {"count": count, "time": total, "histogram": dict(zip(bucket_names,histogram))}
+                          for name, (count, total, histogram) in sorted(self.operations.items())}
+            return {"operations": operations, "counters": dict(self.counters)}
+
+# Decorator recording the calls of a method in the metrics of its object. Generators are
+# measured until they are exhausted
+def timed(name):
+    def decorator(method):
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def wrapper(self,*args,**kw):
+                start = time.perf_counter()
+                try:
+                    yield from method(self,*args,**kw)
+                finally:
+                    self.metrics.record(name,time.perf_counter() - start)
+        else:
+            @functools.wraps(method)
+            def wrapper(self,*args,**kw):
+                start = time.perf_counter()
+                try:
+                    return method(self,*args,**kw)
+                finally:
+                    self.metrics.record(name,time.perf_counter() - start)
+        return wrapper
+    return decorator
 
 # Custom exception for OCFL-related problems
 class OCFLException(Exception):
     def __init__(self,msg):
         super().__init__(msg)
 
+# Bounded LRU cache of parsed inventories keyed by object id. Entries are only valid as long
+# as the inventory file keeps its modification time and size and, optionally, its sidecar
+class InventoryCache():
+
+    def __init__(self,max_size=128,check_sidecar=False):
+        self.max_size = max_size
+        self.check_sidecar = check_sidecar
+        # Map from object id to a tuple of the validation key and the inventory
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Computes the key to check if a cached inventory is still valid
+    def get_key(self,inventory_file,digest_algorithm):
+        st = os.stat(inventory_file)
+        if not self.check_sidecar:
+            return (st.st_mtime_ns, st.st_size)
+        with open(inventory_file + "." + digest_algorithm,"r") as f:
+            return (st.st_mtime_ns, st.st_size, f.read())
+
+    # Returns the cached inventory or None if it is missing or outdated
+    def get(self,id,inventory_file):
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is not None:
+                key, inventory = entry
+                try:
+                    if key == self.get_key(inventory_file,inventory['digestAlgorithm']):
+                        self.entries.move_to_end(id)
+                        self.hits += 1
+                        return inventory
+                except OSError:
+                    pass
+                self.entries.pop(id)
+            self.misses += 1
+            return None
+
+    # Adds an inventory to the cache, evicting the least recently used ones
+    def put(self,id,inventory_file,inventory):
+        key = self.get_key(inventory_file,inventory['digestAlgorithm'])
+        with self.lock:
+            self.entries[id] = (key, inventory)
+            self.entries.move_to_end(id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Removes an inventory from the cache
+    def invalidate(self,id):
+        with self.lock:
+            self.entries.pop(id,None)
+
+    # Returns the hit and miss counters
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+# Converts the creation time of a version to a timestamp
+def version_timestamp(version):
+    # Remove the timezone Z marking UTC
+    return datetime.datetime.fromisoformat(version['created'].replace("Z","")).timestamp()
+
+# Node in the path tree of an object. Directories have a map from name to node as children,
+# files have None. The digest is None if the content of a file was changed, stored is set if
+# the file is read from the stored content and size caches the size of the stored content
+class PathNode():
+    __slots__ = ("children", "digest", "stored", "size")
+
+    def __init__(self,children=None,digest=None,stored=False):
+        self.children = children
+        self.digest = digest
+        self.stored = stored
+        self.size = None
+
+    # Checks if the node is a directory
+    def is_dir(self):
+        return self.children is not None
+
+# Read-only view of a version of a stored object. Files are read directly from the stored
+# content files, files with the same digest share the same content file
+class ObjectTree():
+
+    def __init__(self,id,created):
+        self.id = id
+        # Modification time for everything that has not been changed
+        self.created = created
+        # Tree of all directories and files, paths are resolved one name at a time
+        self.root = PathNode({})
+        # Digest algorithm, path and manifest of the stored object to find the content files
+        self.digest_algorithm = None
+        self.object_path = None
+        self.manifest = {}
+
+    # Creates a view of one version of a stored object
+    @classmethod
+    def from_version(cls,id,object_path,inventory,version):
+        tree = cls(id,version_timestamp(inventory['versions'][version]))
+        tree.add_state(object_path,inventory,inventory['versions'][version]['state'])
+        return tree
+
+    # Adds all files in the state of a version
+    def add_state(self,object_path,inventory,state):
+        self.digest_algorithm = inventory['digestAlgorithm']
+        self.object_path = object_path
+        self.manifest = inventory['manifest']
+        for digest, paths in state.items():
+            for path in paths:
+                self.add_file(path,digest,stored=True)
+
+    # Gets the node for a path or None if it does not exist
+    def lookup(self,path):
+        node = self.root
+        if path == "":
+            return node
+        for name in path.split("/"):
+            if node.children is None:
+                return None
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    # Gets the node of a file or raises an error if it is not a file
+    def get_file(self,path):
+        node = self.lookup(path)
+        if node is None or node.is_dir():
+            raise FileNotFoundError(errno.ENOENT,"No such file",path)
+        return node
+
+    # Gets the node of a directory or raises an error if it is not a directory
+    def get_dir(self,path):
+        node = self.lookup(path)
+        if node is None or not node.is_dir():
+            raise FileNotFoundError(errno.ENOENT,"No such directory",path)
+        return node
+
+    # Adds a directory and all missing parent directories and returns its node
+    def add_dir(self,path):
+        node = self.root
+        if path == "":
+            return node
+        for name in path.split("/"):
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = PathNode({})
+            elif not child.is_dir():
+                raise NotADirectoryError(errno.ENOTDIR,"Not a directory",path)
+            node = child
+        return node
+
+    # Adds a node at a path, creating missing parent directories
+    def add_node(self,path,node):
+        parent, name = os.path.split(path)
+        self.add_dir(parent).children[name] = node
+        return node
+
+    # Adds a file, backed by stored content if stored is set
+    def add_file(self,path,digest=None,stored=False):
+        return self.add_node(path,PathNode(None,digest,stored))
+
+    # Removes a file or a directory from the tree and returns its node
+    def remove_entry(self,path):
+        parent, name = os.path.split(path)
+        parent_node = self.lookup(parent)
+        if parent_node is None or not parent_node.is_dir():
+            return None
+        return parent_node.children.pop(name,None)
+
+    # Checks if a path is a file
+    def is_file(self,path):
+        node = self.lookup(path)
+        return node is not None and not node.is_dir()
+
+    # Checks if a path is a directory
+    def is_dir(self,path):
+        node = self.lookup(path)
+        return node is not None and node.is_dir()
+
+    # Gets the stored content file of a file node
+    def get_content_path(self,node):
+        return os.path.join(self.object_path,self.manifest[node.digest][0])
+
+    # Returns a tuple of is_dir, size and mtime for a path or None if it does not exist. The size
+    # of stored content never changes, so it is only looked up once
+    def stat(self,path):
+        node = self.lookup(path)
+        if node is None:
+            return None
+        if node.is_dir():
+            return (True, 0, self.created)
+        if node.size is None:
+            node.size = os.stat(self.get_content_path(node)).st_size
+        return (False, node.size, self.created)
+
+    # Lists the entries of a directory
+    def list_dir(self,path):
+        return sorted(self.get_dir(path).children)
+
+    # Iterates over the paths and nodes of all files
+    def iter_files(self):
+        stack = [("",self.root)]
+        while stack:
+            path, node = stack.pop()
+            for name, child in node.children.items():
+                child_path = path + "/" + name if path else name
+                if child.is_dir():
+                    stack.append((child_path,child))
+                else:
+                    yield child_path, child
+
+    # Returns the sorted list of the paths and digests of all files
+    def list_files(self):
+        return sorted((path, node.digest) for path, node in self.iter_files())
+
+    # Gets the path to read the content of a file from
+    def get_read_path(self,path):
+        return self.get_content_path(self.get_file(path))
+
+    # Gets a key identifying the content of a file across all objects and the stored content
+    # file. Returns None for both if the file is not read from the store
+    def get_stored_content(self,path):
+        node = self.get_file(path)
+        if node.digest is None or not node.stored:
+            return None, None
+        return self.digest_algorithm + ":" + node.digest, self.get_content_path(node)
+
+# Store-wide index from digest to a stored content file. New content already stored in another
+# object is linked to the existing file instead of being stored again. The index is kept in an
+# append-only file with one JSON record per content file. A final record marks the index as
+# complete once all stored objects were added
+class DedupIndex():
+
+    def __init__(self,index_file):
+        self.index_file = index_file
+        # Map from digest algorithm and digest to the content path relative to the store root
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.linked_files = 0
+        self.bytes_saved = 0
+
+    # Loads the index file. Returns False if there is no index file yet or it was never completed.
+    # Records added before loading are also in the file, so they are only counted once
+    def load(self):
+        if not os.path.exists(self.index_file):
+            return False
+        complete = False
+        with self.lock:
+            self.linked_files = 0
+            self.bytes_saved = 0
+            with open(self.index_file,"r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave an incomplete last line
+                        continue
+                    if record.get("complete"):
+                        complete = True
+                        continue
+                    self.entries.setdefault((record["algorithm"],record["digest"]),record["path"])
+                    if "saved" in record:
+                        self.linked_files += 1
+                        self.bytes_saved += record["saved"]
+        return complete
+
+    # Records that all stored objects were added to the index
+    def mark_complete(self):
+        with self.lock:
+            with open(self.index_file,"a") as f:
+                f.write(json.dumps({"complete": True}) + "\n")
+
+    # Gets the content path for a digest or None if it is not stored yet
+    def lookup(self,digest_algorithm,digest):
+        with self.lock:
+            return self.entries.get((digest_algorithm,digest))
+
+    # Removes a digest whose content file has disappeared
+    def remove(self,digest_algorithm,digest):
+        with self.lock:
+            self.entries.pop((digest_algorithm,digest),None)
+
+    # Adds a list of tuples of digest algorithm, digest, content path and the number of bytes
+    # saved by linking the content, or None if it was not linked, to the index
+    def add(self,records):
+        with self.lock:
+            with open(self.index_file,"a") as f:
+                for digest_algorithm, digest, path, saved in records:
+                    self.entries.setdefault((digest_algorithm,digest),path)
+                    record = {"algorithm": digest_algorithm, "digest": digest, "path": path}
+                    if saved is not None:
+                        record["saved"] = saved
+                        self.linked_files += 1
+                        self.bytes_saved += saved
+                    f.write(json.dumps(record) + "\n")
+
+    # Returns the number of indexed digests, of linked files and of bytes saved
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "linked_files": self.linked_files, "bytes_saved": self.bytes_saved}
+
+# Cache of fixed-size blocks of stored content files with LRU eviction. Blocks are keyed by
+# the content digest, so they are shared by all objects and versions with the same content.
+# Sequential reads trigger reading the following blocks in the background
+class BlockCache():
+
+    def __init__(self,max_size=64*1024*1024,block_size=128*1024,read_ahead=4):
+        self.block_size = block_size
+        self.max_blocks = max_size // block_size
+        self.read_ahead = read_ahead
+        # Map from content key and block index to the block
+        self.blocks = collections.OrderedDict()
+        # Blocks currently read in the background
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.read_ahead_pool = None
+
+    # Gets a block from the cache or None if it is not cached
+    def get(self,key,index):
+        with self.lock:
+            block = self.blocks.get((key,index))
+            if block is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end((key,index))
+            self.hits += 1
+            return block
+
+    # Adds a block to the cache, evicting the least recently used blocks
+    def put(self,key,index,block):
+        with self.lock:
+            self.blocks[(key,index)] = block
+            self.blocks.move_to_end((key,index))
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+    # Reads from the content identified by key using the file descriptor fd for missing blocks.
+    # Sequential reads also read the following blocks from content_path in the background
+    def read(self,key,content_path,fd,size,offset,sequential=False):
+        if self.max_blocks == 0:
+            return os.pread(fd,size,offset)
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        chunks = []
+        for index in range(first,last + 1):
+            block = self.get(key,index)
+            if block is None:
+                block = os.pread(fd,self.block_size,index * self.block_size)
+                if block:
+                    self.put(key,index,block)
+            chunks.append(block)
+            # End of file
+            if len(block) < self.block_size:
+                break
+        else:
+            if sequential and self.read_ahead > 0:
+                self.start_read_ahead(key,content_path,last + 1)
+        start = offset - first * self.block_size
+        return b''.join(chunks)[start:start + size]
+
+    # Reads the blocks following a sequential read in the background unless they are cached
+    def start_read_ahead(self,key,content_path,first):
+        with self.lock:
+            indexes = [index for index in range(first,first + self.read_ahead)
+                       if (key,index) not in self.blocks and (key,index) not in self.pending]
+            if not indexes:
+                return
+            self.pending.update((key,index) for index in indexes)
+            if self.read_ahead_pool is None:
+                self.read_ahead_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.read_ahead_pool.submit(self.read_blocks,key,content_path,indexes)
+
+    # Reads blocks from a content file into the cache. The file is opened again because the
+    # file handle of the reader can be closed at any time
+    def read_blocks(self,key,content_path,indexes):
+        try:
+            with open(content_path,'rb') as f:
+                for index in indexes:
+                    block = os.pread(f.fileno(),self.block_size,index * self.block_size)
+                    if not block:
+                        break
+                    self.put(key,index,block)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending.difference_update((key,index) for index in indexes)
+
+    # Returns the number of cached blocks, hits and misses
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"blocks": len(self.blocks), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+# Write-back buffer of one open staged file. Adjacent writes are collected and written to the
+# file descriptor in one call when the buffer is flushed
+class WriteBuffer():
+
+    def __init__(self,pool,id,fd,path):
+        self.pool = pool
+        self.id = id
+        self.fd = fd
+        # Path of the file in the object to report the size including the buffered data
+        self.path = path
+        self.lock = threading.Lock()
+        # Offset of the buffered data in the file
+        self.offset = 0
+        self.data = bytearray()
+
+    # Buffers data written at an offset. Data that is not adjacent to the buffered data
+    # flushes the buffer first
+    def write(self,data,offset):
+        with self.lock:
+            if self.data and offset != self.offset + len(self.data):
+                self.flush_locked()
+            if not self.data:
+                self.offset = offset
+            self.data += data
+            over_limit = self.pool.reserve(len(data))
+            if over_limit or len(self.data) >= self.pool.buffer_size:
+                self.flush_locked()
+
+    # Returns the end of the buffered data in the file or 0 if nothing is buffered
+    def get_end(self):
+        with self.lock:
+            return self.offset + len(self.data) if self.data else 0
+
+    # Writes the buffered data to the file
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.data:
+            return
+        data = memoryview(self.data)
+        offset = self.offset
+        # The buffer is emptied even if writing fails so the error is only reported once
+        self.data = bytearray()
+        self.pool.release(len(data))
+        while data:
+            written = os.pwrite(self.fd,data,offset)
+            data = data[written:]
+            offset += written
+
+# All write-back buffers of open staged files. Buffers are flushed when they reach the buffer size
+# or when all buffers together exceed the limit
+class WriteBufferPool():
+
+    def __init__(self,buffer_size=1024*1024,limit=64*1024*1024):
+        self.buffer_size = buffer_size
+        self.limit = limit
+        self.lock = threading.Lock()
+        # Open buffers by object id
+        self.buffers = {}
+        # Bytes currently buffered
+        self.size = 0
+        self.writes = 0
+        self.flushes = 0
+
+    # Creates a buffer for a file descriptor of a staged file or returns None if buffering is disabled
+    def open(self,id,fd,path):
+        if self.buffer_size == 0:
+            return None
+        buffer = WriteBuffer(self,id,fd,path)
+        with self.lock:
+            self.buffers.setdefault(id,set()).add(buffer)
+        return buffer
+
+    # Flushes a buffer and removes it from the pool
+    def close(self,buffer):
+        try:
+            buffer.flush()
+        finally:
+            with self.lock:
+                buffers = self.buffers.get(buffer.id)
+                if buffers is not None:
+                    buffers.discard(buffer)
+                    if not buffers:
+                        del self.buffers[buffer.id]
+
+    # Flushes all buffers of an object
+    def flush(self,id):
+        with self.lock:
+            buffers = list(self.buffers.get(id,()))
+        for buffer in buffers:
+            buffer.flush()
+
+    # Returns the end of the data buffered for a file of an object, so its size can be reported
+    # without flushing the buffers
+    def get_end(self,id,path):
+        with self.lock:
+            buffers = [buffer for buffer in self.buffers.get(id,()) if buffer.path == path]
+        return max([buffer.get_end() for buffer in buffers],default=0)
+
+    # Updates the paths of the buffers of files that were renamed or moved with their directory
+    def rename(self,id,old_path,path):
+        with self.lock:
+            for buffer in self.buffers.get(id,()):
+                if buffer.path == old_path:
+                    buffer.path = path
+                elif buffer.path.startswith(old_path + "/"):
+                    buffer.path = path + buffer.path[len(old_path):]
+
+    # Accounts for newly buffered data. Returns True if the limit is exceeded
+    def reserve(self,size):
+        with self.lock:
+            self.size += size
+            self.writes += 1
+            return self.size > self.limit
+
+    # Accounts for flushed data
+    def release(self,size):
+        with self.lock:
+            self.size -= size
+            self.flushes += 1
+
+    # Returns the number of open buffers, the bytes buffered and the number of writes and flushes
+    def stats(self):
+        with self.lock:
+            return {"buffers": sum(len(buffers) for buffers in self.buffers.values()), "size": self.size,
+                    "writes": self.writes, "flushes": self.flushes}
+
+# Limits the rate of reads shared by several threads to a number of bytes per second
+class RateLimiter():
+
+    def __init__(self,rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        # Time at which the bytes consumed so far are paid for
+        self.next_time = time.monotonic()
+
+    # Waits until a number of bytes can be read without exceeding the rate
+    def consume(self,size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time,now) + size / self.rate
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+# Verifies all stored content files against the digests in the inventories in the background.
+# Objects are checked one after another in the order of their ids and the position is saved
+# after each object, so a check continues where it stopped after a restart. A new pass starts
+# after an interval once all objects are checked
+class FixityChecker():
+
+    # Maximum number of findings kept
+    MAX_FINDINGS = 1000
+
+    def __init__(self,ocflpy,state_file,rate=10*1024*1024,workers=2,interval=24*60*60):
+        self.ocflpy = ocflpy
+        self.state_file = state_file
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.state = self.new_pass(1)
+        self.load()
+
+    # Returns the state at the start of a pass
+    def new_pass(self,number):
+        return {"pass": number, "position": None, "started": time.time(), "finished": None,
+                "objects": 0, "files": 0, "bytes": 0, "failures": 0, "findings": []}
+
+    # Loads the state of an interrupted pass
+    def load(self):
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file,"r") as f:
+                    self.state.update(json.load(f))
+            except ValueError as e:
+                self.ocflpy.log.warning("Cannot read fixity state %s: %s", self.state_file, e)
+
+    # Saves the state atomically
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.state)
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file,"w") as f:
+            f.write(data)
+        os.replace(tmp_file,self.state_file)
+
+    def start(self):
+        self.thread.start()
+
+    # Stops the check after the current object
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    # Returns a copy of the state
+    def status(self):
+        with self.lock:
+            return json.loads(json.dumps(self.state))
+
+    # Runs passes over all objects until stopped
+    def run(self):
+        # Leave the processor to the file system requests where the platform allows it
+        try:
+            os.setpriority(os.PRIO_PROCESS,threading.get_native_id(),19)
+        except (AttributeError, OSError):
+            pass
+        self.ocflpy.wait_for_index()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(self.workers,1))
+        try:
+            while not self.stopped.is_set():
+                # Wait for the next pass
+                if self.state["finished"] is not None:
+                    delay = self.state["finished"] + self.interval - time.time()
+                    if delay > 0 and self.stopped.wait(delay):
+                        return
+                    with self.lock:
+                        self.state = self.new_pass(self.state["pass"] + 1)
+                start = self.ocflpy.get_object_id_position(self.state["position"])
+                for id in self.ocflpy.iter_object_ids(start):
+                    if self.stopped.is_set():
+                        return
+                    self.check_object(pool,id)
+                    self.save()
+                with self.lock:
+                    self.state["finished"] = time.time()
+                self.save()
+        except Exception as e:
+            self.ocflpy.log.error("Fixity check failed: %s", e)
+        finally:
+            pool.shutdown(wait=False)
+
+    # Checks all content files of an object
+    def check_object(self,pool,id):
+        object_path = self.ocflpy.get_object_path(id)
+        try:
+            inventory = self.ocflpy.get_object_inventory(id)
+        except Exception as e:
+            self.add_findings(id,[id + ": cannot read inventory: " + str(e)],0,0)
+            return
+        digest_algorithm = inventory['digestAlgorithm']
+        content = [(digest, path) for digest, paths in inventory['manifest'].items() for path in paths]
+        results = pool.map(lambda entry: self.check_file(os.path.join(object_path,entry[1]),digest_algorithm,entry[0]),content)
+        findings = []
+        size = 0
+        for (digest, path), (file_size, error) in zip(content,results):
+            size += file_size
+            if error is not None:
+                findings.append(id + ": " + path + ": " + error)
+        self.add_findings(id,findings,len(content),size)
+
+    # Checks a single content file. Returns its size and an error or None
+    def check_file(self,filename,digest_algorithm,digest):
+        try:
+            size = os.path.getsize(filename)
+            if compute_digest(filename,digest_algorithm,self.limiter) != digest.lower():
+                return size, "digest mismatch"
+            return size, None
+        except OSError as e:
+            return 0, e.strerror
+
+    # Records the outcome of checking an object
+    def add_findings(self,id,findings,files,size):
+        with self.lock:
+            self.state["position"] = id
+            self.state["objects"] += 1
+            self.state["files"] += files
+            self.state["bytes"] += size
+            self.state["failures"] += len(findings)
+            self.state["findings"] = (self.state["findings"] + findings)[:self.MAX_FINDINGS]
+
+# Logical view of a staged object. Files are served from the stored object until they are
+# changed and only then copied into the staging directory (copy-on-write)
+class StagedObject(ObjectTree):
+
+    def __init__(self,id,staging_path,created):
+        ObjectTree.__init__(self,id,created)
+        # Serializes all changes to this object
+        self.lock = threading.RLock()
+        # The folder in staging containing the files copied from the store
+        self.staging_path = staging_path
+        # Journal of all changes so the staged object survives a restart. It is only written once
+        # something changes, until then the base record stays in memory and neither the journal
+        # nor the folder in staging exist
+        self.journal = None
+        self.journal_base = None
+        # Set while the journal is replayed, the changes are already in staging then
+        self.replaying = False
+        # Set once anything was changed
+        self.changed = False
+        # File descriptors of the files open for writing
+        self.open_files = set()
+
+    # Creates a view of a version of a stored object, by default of the head version
+    @classmethod
+    def from_inventory(cls,id,staging_path,object_path,inventory,version=None):
+        if version is None:
+            version = inventory['head']
+        staged_object = cls(id,staging_path,version_timestamp(inventory['versions'][version]))
+        staged_object.add_state(object_path,inventory,inventory['versions'][version]['state'])
+        return staged_object
+
+    # Gets the path of the journal of a staged object
+    @staticmethod
+    def get_journal_path(staging_path):
+        return staging_path + ".journal"
+
+    # Starts a new journal recording the version the object was staged from. The journal is
+    # created with the first record written to it
+    def start_journal(self,version):
+        self.journal_base = {"op": "base", "id": self.id, "version": version, "created": self.created}
+
+    # Creates the folder in staging and the journal starting with the base record
+    def create_journal(self):
+        os.makedirs(self.staging_path,exist_ok=True)
+        journal_path = self.get_journal_path(self.staging_path)
+        with open(journal_path,"w") as f:
+            f.write(json.dumps(self.journal_base) + "\n")
+        self.journal = journal_path
+
+    # Continues an existing journal
+    def open_journal(self):
+        self.journal = self.get_journal_path(self.staging_path)
+
+    # Removes the journal, nothing is recorded afterwards
+    def remove_journal(self):
+        self.journal_base = None
+        if self.journal is not None:
+            os.remove(self.journal)
+            self.journal = None
+
+    # Appends a record to the journal. Records are written after the change is done in staging.
+    # The journal is not kept open, so staged objects do not use up file descriptors
+    def write_journal(self,record):
+        if self.replaying or (self.journal is None and self.journal_base is None):
+            return
+        if self.journal is None:
+            self.create_journal()
+        with open(self.journal,"a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    # Records a change
+    def log_change(self,record):
+        self.changed = True
+        self.write_journal(record)
+
+    # Applies the records of a journal to the view of the version the object was staged from
+    def replay(self,records):
+        self.replaying = True
+        try:
+            for record in records:
+                op = record["op"]
+                # Records that do not apply are skipped, e.g. a change repeated after a crash
+                try:
+                    if op == "changed" or op == "staged":
+                        # The file is in staging
+                        node = self.lookup(record["path"])
+                        if node is None:
+                            node = self.add_file(record["path"])
+                        node.stored = False
+                        node.size = None
+                        if op == "changed":
+                            node.digest = None
+                    elif op == "mkdir":
+                        self.make_dir(record["path"])
+                    elif op == "remove":
+                        self.remove_file(record["path"])
+                    elif op == "rmdir":
+                        self.remove_dir(record["path"])
+                    elif op == "rename":
+                        self.rename(record["old_path"],record["path"])
+                except (OSError, KeyError):
+                    continue
+                if op not in ("base","commit","rollback"):
+                    self.changed = True
+        finally:
+            self.replaying = False
+
+    # Gets the path of a file in the staging directory
+    def get_staged_path(self,path):
+        return os.path.join(self.staging_path,path)
+
+    # Returns a tuple of is_dir, size and mtime for a path or None if it does not exist
+    def stat(self,path):
+        node = self.lookup(path)
+        if node is not None and not node.is_dir() and not node.stored:
+            st = os.stat(self.get_staged_path(path))
+            return (False, st.st_size, st.st_mtime)
+        return ObjectTree.stat(self,path)
+
+    # Gets the path to read the content of a file from
+    def get_read_path(self,path):
+        node = self.get_file(path)
+        if not node.stored:
+            return self.get_staged_path(path)
+        return self.get_content_path(node)
+
+    # Copies a file into staging if necessary and returns its path in staging. Unless the
+    # digest is kept the file is considered as changed
+    def materialize(self,path,keep_digest=False):
+        node = self.get_file(path)
+        staged_path = self.get_staged_path(path)
+        if node.stored or (node.digest is not None and not keep_digest):
+            if node.stored:
+                os.makedirs(os.path.dirname(staged_path),exist_ok=True)
+                clone_file(self.get_content_path(node),staged_path)
+                os.utime(staged_path,times=(time.time(),self.created))
+            node.stored = False
+            node.size = None
+            # Files copied without changing them do not count as changes and are only recorded
+            # in an existing journal, without one they are read from the store again
+            if keep_digest:
+                if self.journal is not None:
+                    self.write_journal({"op": "staged", "path": path})
+            else:
+                node.digest = None
+                self.log_change({"op": "changed", "path": path})
+        return staged_path
+
+    # Copies all files still in the store into staging without marking them as changed
+    def materialize_all(self):
+        for path, node in list(self.iter_files()):
+            if node.stored:
+                self.materialize(path,keep_digest=True)
+
+    # Truncates a file in staging. A stored file truncated to zero is not copied into staging
+    # just to throw its content away
+    def truncate(self,path,length):
+        node = self.get_file(path)
+        if node.stored and length == 0:
+            staged_path = self.get_staged_path(path)
+            os.makedirs(os.path.dirname(staged_path),exist_ok=True)
+            open(staged_path,'wb').close()
+            node.stored = False
+            node.size = None
+            node.digest = None
+            self.log_change({"op": "changed", "path": path})
+        else:
+            os.truncate(self.materialize(path),length)
+
+    # Opens a staged file for writing and returns the file descriptor
+    def open_file(self,path,flags):
+        if flags & os.O_TRUNC:
+            self.truncate(path,0)
+        fd = os.open(self.materialize(path),flags)
+        self.open_files.add(fd)
+        return fd
+
+    # Closes a file descriptor returned by open_file
+    def close_file(self,fd):
+        self.open_files.discard(fd)
+        os.close(fd)
+
+    # Lists all files that were changed in staging
+    def list_changed_files(self):
+        return [path for path, node in self.iter_files() if node.digest is None]
+
+    # Creates a new empty file in staging
+    def create_file(self,path):
+        parent, name = os.path.split(path)
+        parent_node = self.get_dir(parent)
+        node = parent_node.children.get(name)
+        if node is not None and node.is_dir():
+            raise IsADirectoryError(errno.EISDIR,"Is a directory",path)
+        if node is None:
+            staged_path = self.get_staged_path(path)
+            os.makedirs(os.path.dirname(staged_path),exist_ok=True)
+            open(staged_path,'wb').close()
+            parent_node.children[name] = PathNode()
+            self.log_change({"op": "changed", "path": path})
+
+    # Creates a new directory
+    def make_dir(self,path):
+        parent, name = os.path.split(path)
+        parent_node = self.get_dir(parent)
+        if name in parent_node.children:
+            raise FileExistsError(errno.EEXIST,"File exists",path)
+        parent_node.children[name] = PathNode({})
+        self.log_change({"op": "mkdir", "path": path})
+
+    # Removes a file
+    def remove_file(self,path):
+        node = self.get_file(path)
+        self.remove_entry(path)
+        if not node.stored and not self.replaying:
+            os.remove(self.get_staged_path(path))
+        self.log_change({"op": "remove", "path": path})
+
+    # Removes an empty directory
+    def remove_dir(self,path):
+        node = self.get_dir(path)
+        if node.children or path == "":
+            raise OSError(errno.ENOTEMPTY,"Directory not empty",path)
+        self.remove_entry(path)
+        staged_path = self.get_staged_path(path)
+        if os.path.isdir(staged_path) and not self.replaying:
+            os.rmdir(staged_path)
+        self.log_change({"op": "rmdir", "path": path})
+
+    # Renames a file or directory. Directories are moved as a whole including their staged files
+    def rename(self,old_path,path):
+        node = self.lookup(old_path)
+        if node is None or old_path == "":
+            raise FileNotFoundError(errno.ENOENT,"No such file or directory",old_path)
+        target = self.lookup(path)
+        if not node.is_dir():
+            if target is not None and target.is_dir():
+                raise IsADirectoryError(errno.EISDIR,"Is a directory",path)
+            if target is not None:
+                self.remove_file(path)
+            self.move_file(old_path,path)
+        else:
+            if path.startswith(old_path + "/"):
+                raise OSError(errno.EINVAL,"Invalid argument",path)
+            if target is not None and not target.is_dir():
+                raise NotADirectoryError(errno.ENOTDIR,"Not a directory",path)
+            if target is not None:
+                self.remove_dir(path)
+            self.remove_entry(old_path)
+            self.add_node(path,node)
+            old_staged_path = self.get_staged_path(old_path)
+            if os.path.isdir(old_staged_path) and not self.replaying:
+                staged_path = self.get_staged_path(path)
+                os.makedirs(os.path.dirname(staged_path),exist_ok=True)
+                os.rename(old_staged_path,staged_path)
+        self.log_change({"op": "rename", "old_path": old_path, "path": path})
+
+    # Moves a single file to a new path
+    def move_file(self,old_path,path):
+        node = self.remove_entry(old_path)
+        if not node.stored and not self.replaying:
+            staged_path = self.get_staged_path(path)
+            os.makedirs(os.path.dirname(staged_path),exist_ok=True)
+            os.rename(self.get_staged_path(old_path),staged_path)
+        self.add_node(path,node)
+
 # Wrapper class around the ocfl reference implementation to add basic transactions
 class OCFLPY():
 
@@ -30,22 +1213,33 @@ class OCFLPY():
     def decode_id(self,id):
         return self.dispositor.decode(id)
 
-    def __init__(self,root,staging_dir,disposition, verbose=False):
+    def __init__(self,root,staging_dir,disposition, verbose=False, index_file=None, check_index=False, lazy=True,
+                 digest_workers=None, digest_processes=False, inventory_cache_size=128, inventory_cache_sidecar=False,
+                 commit_workers=1, dedup_index=None, block_cache_size=64*1024*1024, block_size=128*1024, read_ahead=4,
+                 validate=False, start=True, write_buffer_size=1024*1024, write_buffer_limit=64*1024*1024,
+                 sync_commits=False, fixity_state=None, fixity_rate=10*1024*1024, fixity_workers=2,
+                 fixity_interval=24*60*60, writers_timeout=10.0):
         # The store root
         self.root = root
         # Load the store
+        self.disposition = disposition
         self.store = Store(root,disposition=disposition)
         self.store.log = logging.getLogger(name="ocfl.store")
         self.store.log.setLevel(level=logging.INFO if verbose else logging.WARN)
         self.log=logging.getLogger("ocfl_wrapper")
-        self.log.info(str(self.store.dispositor))
+        self.log.info("%s", self.store.dispositor)
         if not verbose:
             self.log.setLevel(logging.WARNING)
         else:
             self.log.setLevel(logging.DEBUG)
+        # Run time of all operations
+        self.metrics = Metrics()
         # Initialize if the root does not exist
         if not os.path.exists(root):
             self.store.initialize()
+        # Only check the root declaration here, everything else is done in the background
+        if not any(name.startswith("0=ocfl_") for name in os.listdir(root)):
+            raise OCFLException("Not an OCFL storage root " + root)
         # The staging dir
         self.staging_dir = staging_dir
         # create if missing
@@ -53,13 +1247,462 @@ class OCFLPY():
                os.mkdir(staging_dir)
         # Keep track of staging objects
         self.staging_objects = {}
+        # Protects the staging objects, the index and the store itself
+        self.staging_lock = threading.Lock()
+        self.index_lock = threading.RLock()
+        self.store_lock = threading.Lock()
+        # Only copy files into staging when they are changed instead of extracting complete objects
+        self.lazy = lazy
+        # Write all content and inventories to disk before a commit is finished
+        self.sync_commits = sync_commits
+        # Seconds a commit waits for the files of the object still open for writing to be closed
+        self.writers_timeout = writers_timeout
+        # Pool to compute digests in parallel, created on first use
+        self.digest_workers = digest_workers if digest_workers is not None else os.cpu_count()
+        self.digest_processes = digest_processes
+        self.digest_pool = None
+        # Queue for commits running in the background, the status of the most recent commit of
+        # each object and the commits still in progress
+        self.commit_pool = concurrent.futures.ThreadPoolExecutor(max_workers=commit_workers)
+        self.commit_status = {}
+        self.commit_futures = {}
+        self.commit_lock = threading.Lock()
+        # Outcome of the most recent ingest of several objects
+        self.ingest_results = {}
+        # Cache for parsed inventories
+        self.inventory_cache = InventoryCache(inventory_cache_size,inventory_cache_sidecar)
+        # Cache for blocks of stored content files
+        self.block_cache = BlockCache(block_cache_size,block_size,read_ahead)
+        # Write-back buffers of open staged files
+        self.write_buffers = WriteBufferPool(write_buffer_size,write_buffer_limit)
+        # Cache for the read-only views of stored versions which never change once written
+        self.version_trees = collections.OrderedDict()
+        self.version_trees_size = inventory_cache_size
+        self.version_lock = threading.Lock()
         # Local dispositor to access the methods
         self.dispositor=Dispositor()
+        # Index of all object ids in the store as a sorted list and the map from id to object path
+        self.object_ids = []
+        self.object_paths = {}
+        # Optional sidecar file to persist the index between mounts. Objects added later are
+        # appended to a log next to it, which is merged into the index on mount and unmount
+        self.index_file = index_file
+        self.index_log_lock = threading.Lock()
+        # Set once the index is complete. Until then objects are looked up directly in the store
+        self.index_ready = threading.Event()
+        # Objects that could not be indexed and the error that stopped indexing, if any. With an
+        # error the index is incomplete and objects are still looked up in the store
+        self.index_findings = []
+        self.index_error = None
+        # Optional store-wide index to deduplicate content across objects. It exists right away,
+        # so commits are recorded while it is loaded or built in the background
+        self.dedup_index = DedupIndex(dedup_index) if dedup_index is not None else None
+        # Outcome of the optional validation of the store
+        self.validation_status = "not validated" if validate else None
+        self.validation_findings = []
+        # Optional background check of the stored content against the inventories
+        self.fixity_checker = None
+        if fixity_state is not None:
+            self.fixity_checker = FixityChecker(self,fixity_state,fixity_rate,fixity_workers,fixity_interval)
+        # Adopt the objects staged before a restart
+        self.recover_staging()
+        # Load or build all indexes and validate the store in the background, so the store
+        # is available right away
+        self.background_init = threading.Thread(target=self.init_in_background,
+                                                args=(check_index,validate),daemon=True)
+        if start:
+            self.start()
+
+    # Adopts all objects staged before the last shutdown or crash using their journals. A commit
+    # that was interrupted is either finished, if the new version is already visible, or rolled
+    # back. Everything in staging without a journal is removed
+    @timed("ocflpy.recover_staging")
+    def recover_staging(self):
+        journals = {}
+        for name in os.listdir(self.staging_dir):
+            if name.endswith(".journal"):
+                journals[name[:-len(".journal")]] = os.path.join(self.staging_dir,name)
+        for name in os.listdir(self.staging_dir):
+            path = os.path.join(self.staging_dir,name)
+            if name.endswith(".journal") or name in journals:
+                continue
+            self.log.info("Removing from staging: %s", path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        for name, journal_path in sorted(journals.items()):
+            staging_path = os.path.join(self.staging_dir,name)
+            try:
+                self.recover_staged_object(staging_path,journal_path)
+            except Exception as e:
+                self.log.error("Cannot recover staged object %s: %s", staging_path, e)
+
+    # Adopts a single staged object from its journal
+    def recover_staged_object(self,staging_path,journal_path):
+        records = []
+        with open(journal_path,"r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A crash can leave an incomplete last line
+                    break
+        if not records or records[0]["op"] != "base" or not os.path.isdir(staging_path):
+            self.log.warning("Discarding staging without valid journal: %s", staging_path)
+            os.remove(journal_path)
+            if os.path.isdir(staging_path):
+                shutil.rmtree(staging_path)
+            return
+        base = records[0]
+        id = base["id"]
+        # The last commit that was not rolled back
+        commit = None
+        for record in records:
+            if record["op"] == "commit":
+                commit = record["version"]
+            elif record["op"] == "rollback":
+                commit = None
+        inventory = self.get_object_inventory(id) if self.has_object(id) else None
+        if commit is not None:
+            new_object = staging_path + "_obj"
+            if inventory is not None and commit in inventory['versions']:
+                # The commit is finished, the staged changes are in the store
+                self.log.info("Finishing commit of %s at %s", id, commit)
+                if os.path.isdir(new_object):
+                    shutil.rmtree(new_object)
+                if base["version"] is None:
+                    self.add_to_index(id)
+                os.remove(journal_path)
+                shutil.rmtree(staging_path)
+                return
+            # Roll back the incomplete version, the root inventory does not refer to it
+            self.log.info("Rolling back commit of %s at %s", id, commit)
+            if os.path.isdir(new_object):
+                shutil.rmtree(new_object)
+            if inventory is not None:
+                version_path = os.path.join(self.get_object_path(id),commit)
+                if os.path.isdir(version_path):
+                    shutil.rmtree(version_path)
+            elif os.path.isdir(self.get_object_path(id)):
+                # A new object written directly into the store
+                shutil.rmtree(self.get_object_path(id))
+            records.append({"op": "rollback"})
+        if base["version"] is None:
+            staged_object = StagedObject(id,staging_path,base["created"])
+            staged_object.changed = True
+        else:
+            staged_object = StagedObject.from_inventory(id,staging_path,self.get_object_path(id),inventory,base["version"])
+        staged_object.replay(records[1:])
+        # Files missing in staging cannot be recovered
+        for path in staged_object.list_changed_files():
+            if not os.path.isfile(staged_object.get_staged_path(path)):
+                self.log.warning("Staged file of %s missing: %s", id, path)
+                staged_object.remove_entry(path)
+        staged_object.open_journal()
+        if commit is not None:
+            staged_object.write_journal({"op": "rollback"})
+        self.log.info("Adopted staged object %s", id)
+        with self.staging_lock:
+            self.staging_objects[id] = staged_object
+
+    # Starts indexing in the background. Has to be called explicitly if the process forks after
+    # creating the wrapper
+    def start(self):
+        self.background_init.start()
+        if self.fixity_checker is not None:
+            self.fixity_checker.start()
+
+    # Loads or builds the object index and the dedup index and validates the store
+    def init_in_background(self,check_index,validate):
+        try:
+            if not self.load_index():
+                self.build_index()
+            if check_index:
+                self.check_index()
+            if self.dedup_index is not None and not self.dedup_index.load():
+                self.build_dedup_index(self.dedup_index)
+        except Exception as e:
+            self.log.error("Cannot index store %s: %s", self.root, e)
+            self.index_error = str(e)
+        finally:
+            # Listings waiting for the index must never hang, even if it is incomplete
+            self.index_ready.set()
+        if validate:
+            self.validate_store()
+
+    # Waits until the object index is complete
+    def wait_for_index(self,timeout=None):
+        return self.index_ready.wait(timeout)
+
+    # Walks the store and returns a map from object id to object path relative to the root
+    @timed("ocflpy.scan_store")
+    def scan_store(self):
+        object_paths = {}
+        # Use a separate instance because the store is also used while scanning
+        store = Store(self.root,disposition=self.disposition)
+        store.open_root_fs()
+        for dirpath in store.object_paths():
+            # Unreadable objects are skipped and reported instead of stopping the scan
+            try:
+                with open(os.path.join(self.root,dirpath,"inventory.json"),"r") as f:
+                    object_paths[json.load(f)["id"]] = dirpath
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.log.warning("Cannot index object %s: %s", dirpath, e)
+                self.index_findings.append(dirpath + ": cannot read inventory: " + str(e))
+        return object_paths
+
+    # Builds the object index from scratch by walking the store
+    @timed("ocflpy.build_index")
+    def build_index(self):
+        self.log.info("BUILD INDEX: %s", self.root)
+        object_paths = self.scan_store()
+        with self.index_lock:
+            # Keep objects added while scanning
+            object_paths.update(self.object_paths)
+            self.object_paths = object_paths
+            self.object_ids = sorted(object_paths.keys())
+            self.index_ready.set()
+        self.save_index()
+
+    # Loads the object index from the sidecar file. Returns False if there is no usable index file
+    @timed("ocflpy.load_index")
+    def load_index(self):
+        if self.index_file is not None and os.path.exists(self.index_file):
+            try:
+                with open(self.index_file,"r") as f:
+                    index = json.load(f)
+                if index["root"] == os.path.abspath(self.root):
+                    self.log.info("LOAD INDEX: %s", self.index_file)
+                    logged = self.read_index_log()
+                    with self.index_lock:
+                        index["objects"].update(logged)
+                        index["objects"].update(self.object_paths)
+                        self.object_paths = index["objects"]
+                        self.object_ids = sorted(self.object_paths.keys())
+                        self.index_ready.set()
+                    if logged:
+                        self.save_index()
+                    return True
+                self.log.warning("Index file %s belongs to a different root", self.index_file)
+            except (ValueError, KeyError) as e:
+                self.log.warning("Cannot read index file %s: %s", self.index_file, e)
+        return False
+
+    # Gets the path of the log of objects added since the index file was written
+    def get_index_log_path(self):
+        return self.index_file + ".log"
+
+    # Reads the map from object id to object path of all objects in the index log
+    def read_index_log(self):
+        object_paths = {}
+        if os.path.exists(self.get_index_log_path()):
+            with open(self.get_index_log_path(),"r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave an incomplete last line
+                        continue
+                    object_paths[record["id"]] = record["path"]
+        return object_paths
 
-    # Returns the list of all object ids
+    # Writes the complete object index to the sidecar file if one is used and removes the log,
+    # which is merged into it
+    @timed("ocflpy.save_index")
+    def save_index(self):
+        # An incomplete index is never saved, so the store is scanned again on the next mount
+        if self.index_file is None or not self.index_ready.is_set() or self.index_error is not None or self.index_findings:
+            return
+        # Write to a temporary file first so a crash never leaves a broken index. Listings only
+        # wait for the copy of the index, not for writing it
+        tmp_file = self.index_file + ".tmp"
+        with self.index_log_lock:
+            with self.index_lock:
+                object_paths = dict(self.object_paths)
+            with open(tmp_file,"w") as f:
+                json.dump({"root": os.path.abspath(self.root), "objects": object_paths},f)
+            os.replace(tmp_file,self.index_file)
+            if os.path.exists(self.get_index_log_path()):
+                os.remove(self.get_index_log_path())
+
+    # Checks the index against the store and rebuilds it on mismatch. Returns True if it was consistent
+    @timed("ocflpy.check_index")
+    def check_index(self):
+        object_paths = self.scan_store()
+        with self.index_lock:
+            if object_paths == self.object_paths:
+                return True
+            missing = set(object_paths.keys()) - set(self.object_paths.keys())
+            stale = set(self.object_paths.keys()) - set(object_paths.keys())
+            self.log.warning("Index out of sync with store: %s missing, %s stale entries", len(missing), len(stale))
+            self.object_paths = object_paths
+            self.object_ids = sorted(object_paths.keys())
+        self.save_index()
+        return False
+
+    # Adds an object to the index. Only the new object is appended to the index log, so adding
+    # an object does not rewrite the whole index
+    def add_to_index(self,id):
+        object_path = self.store.object_path(id)
+        with self.index_lock:
+            if id not in self.object_paths:
+                bisect.insort(self.object_ids,id)
+            self.object_paths[id] = object_path
+        if self.index_file is not None:
+            with self.index_log_lock:
+                with open(self.get_index_log_path(),"a") as f:
+                    f.write(json.dumps({"id": id, "path": object_path}) + "\n")
+
+    # Adds the content of all stored objects to a dedup index. Objects committed in the meantime
+    # add their content themselves
+    @timed("ocflpy.build_dedup_index")
+    def build_dedup_index(self,dedup_index):
+        self.log.info("BUILD DEDUP INDEX: %s", self.root)
+        records = []
+        for id in self.list_object_ids():
+            try:
+                inventory = self.get_object_inventory(id)
+            except (OSError, ValueError, KeyError) as e:
+                self.log.warning("Cannot index content of %s: %s", id, e)
+                continue
+            for digest, paths in inventory['manifest'].items():
+                records.append((inventory['digestAlgorithm'],digest,os.path.join(self.object_paths[id],paths[0]),None))
+        dedup_index.add(records)
+        dedup_index.mark_complete()
+
+    # Links the content file of a digest stored in any object to a new place. Returns False
+    # if the digest is not stored yet or the file cannot be linked
+    def link_stored_content(self,digest_algorithm,digest,dstfile):
+        path = self.dedup_index.lookup(digest_algorithm,digest)
+        if path is None:
+            return False
+        stored_file = os.path.join(self.root,path)
+        try:
+            os.link(stored_file,dstfile)
+            return True
+        except FileNotFoundError:
+            self.dedup_index.remove(digest_algorithm,digest)
+            return False
+        except OSError:
+            return reflink_file(stored_file,dstfile)
+
+    # Returns all metrics together with the state of the caches and queues
+    def get_stats(self):
+        stats = self.metrics.snapshot()
+        stats["inventory_cache"] = self.inventory_cache.stats()
+        stats["block_cache"] = self.block_cache.stats()
+        stats["write_buffers"] = self.write_buffers.stats()
+        stats["index_ready"] = self.index_ready.is_set()
+        stats["index_error"] = self.index_error
+        stats["index_findings"] = len(self.index_findings)
+        if self.fixity_checker is not None:
+            fixity = self.fixity_checker.status()
+            stats["fixity"] = {key: fixity[key] for key in ["pass","position","objects","files","bytes","failures"]}
+        with self.version_lock:
+            stats["version_cache"] = {"size": len(self.version_trees)}
+        if self.dedup_index is not None:
+            stats["dedup"] = self.dedup_index.stats()
+        with self.staging_lock:
+            stats["staged_objects"] = len(self.staging_objects)
+        with self.commit_lock:
+            stats["queued_commits"] = len(self.commit_futures)
+        return stats
+
+    # Returns the number of indexed digests, of linked files and of bytes saved by deduplication
+    def dedup_stats(self):
+        if self.dedup_index is None:
+            return None
+        return self.dedup_index.stats()
+
+    # Checks if an object id is in the store. Until the index is complete objects not yet
+    # indexed are looked up at the path given by the disposition
+    def has_object(self,id):
+        if id in self.object_paths:
+            return True
+        if self.index_ready.is_set() and self.index_error is None:
+            return False
+        return os.path.exists(os.path.join(self.root,self.store.object_path(id),"inventory.json"))
+
+    # Validates the store and all objects in it and records the findings
+    @timed("ocflpy.validate_store")
+    def validate_store(self):
+        self.validation_status = "running"
+        self.wait_for_index()
+        # Objects that could not even be indexed are invalid as well
+        self.validation_findings = list(self.index_findings)
+        if self.index_error is not None:
+            self.validation_findings.append("index incomplete: " + self.index_error)
+        object_ids = self.list_object_ids()
+        invalid = 0
+        for checked, id in enumerate(object_ids):
+            self.validation_status = "running: " + str(checked) + "/" + str(len(object_ids)) + " objects checked"
+            validator = Validator(check_digests=True,show_warnings=False)
+            if not validator.validate(self.get_object_path(id)):
+                invalid += 1
+                self.validation_findings.append(id + ": " + str(validator))
+        invalid += len(self.index_findings)
+        self.validation_status = "done: " + str(len(object_ids) + len(self.index_findings)) + " objects checked, " + str(invalid) + " invalid"
+
+    # Returns the status and the findings of the validation or None if the store is not validated
+    def get_validation_status(self):
+        if self.validation_status is None:
+            return None
+        return self.validation_status, list(self.validation_findings)
+
+    # Returns the position of the first object id following an id in the sorted list of all
+    # object ids, or 0 if no id is given
+    def get_object_id_position(self,id):
+        if id is None:
+            return 0
+        with self.index_lock:
+            return bisect.bisect_right(self.object_ids,id)
+
+    # Returns the number of object ids in the index sorting before an id
+    def count_object_ids_before(self,id):
+        with self.index_lock:
+            return bisect.bisect_left(self.object_ids,id)
+
+    # Returns the object id at a position of the sorted list of all object ids
+    def get_object_id(self,position):
+        with self.index_lock:
+            return self.object_ids[position]
+
+    # Returns the state of the fixity check or None if it is not enabled
+    def get_fixity_status(self):
+        if self.fixity_checker is None:
+            return None
+        return self.fixity_checker.status()
+
+    # Returns the sorted list of all object ids. Listings wait until the index is complete
     def list_object_ids(self):
-        # Get the list from the store
-        return [o["id"] for o in self.store.list()]
+        self.wait_for_index()
+        # Get the list from the index
+        with self.index_lock:
+            return list(self.object_ids)
+
+    # Returns the number of objects in the store
+    def count_object_ids(self):
+        self.wait_for_index()
+        return len(self.object_ids)
+
+    # Iterates over the sorted object ids starting at a position. The ids are read from the index
+    # in chunks, so the complete list is never copied
+    def iter_object_ids(self,start=0,chunk_size=1000):
+        self.wait_for_index()
+        position = start
+        while True:
+            with self.index_lock:
+                chunk = self.object_ids[position:position + chunk_size]
+            if not chunk:
+                return
+            yield from chunk
+            position += len(chunk)
+
+    # Returns the list of all new objects that are staged but not yet in the store
+    def list_new_object_ids(self):
+        with self.staging_lock:
+            return [id for id in self.staging_objects if not self.has_object(id)]
 
     # Returns the list of all objects
     def list_objects(self):
@@ -68,17 +1711,187 @@ class OCFLPY():
 
     # Returns the path of the staging version of an object
     def get_staging_object_path(self,id):
-        self.log.info("STAGING OBJECTS: " + str(self.staging_objects))
-        return os.path.join(self.staging_dir,self.staging_objects[id])
+        return self.get_staged_object(id).staging_path
+
+    # Returns the staged object for an object id
+    def get_staged_object(self,id):
+        with self.staging_lock:
+            if id not in self.staging_objects:
+                raise OCFLException("Object not staged " + id)
+            return self.staging_objects[id]
+
+    # Locks a staged object and returns it. An object committed or reverted while waiting for
+    # the lock is looked up again, so changes never end up in a discarded staged object. With a
+    # timeout the lock is only taken once no file of the object is open for writing, otherwise
+    # an exception is raised after the timeout
+    def acquire_staged_object(self,id,writers_timeout=None):
+        deadline = time.monotonic() + writers_timeout if writers_timeout is not None else None
+        while True:
+            staged_object = self.get_staged_object(id)
+            staged_object.lock.acquire()
+            with self.staging_lock:
+                current = self.staging_objects.get(id) is staged_object
+            if current and (deadline is None or not staged_object.open_files):
+                return staged_object
+            staged_object.lock.release()
+            if current:
+                if time.monotonic() >= deadline:
+                    raise OCFLException("Object has files open for writing " + id)
+                time.sleep(0.1)
+
+    # Context manager holding the lock of the current staged object of an id
+    @contextlib.contextmanager
+    def lock_staged_object(self,id,writers_timeout=None):
+        staged_object = self.acquire_staged_object(id,writers_timeout)
+        try:
+            yield staged_object
+        finally:
+            staged_object.lock.release()
+
+    # Checks if an object is staged
+    def is_staged(self,id):
+        with self.staging_lock:
+            return id in self.staging_objects
+
+    # Returns a tuple of is_dir, size and mtime for a path in a staged object or None if it does not exist
+    @timed("ocflpy.stat_staged_path")
+    def stat_staged_path(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            st = staged_object.stat(path)
+        # Writes still in a buffer can extend the file
+        if st is not None and not st[0]:
+            end = self.write_buffers.get_end(id,path)
+            if end > st[1]:
+                return (False, end, st[2])
+        return st
+
+    # Lists a directory in a staged object
+    @timed("ocflpy.list_staged_dir")
+    def list_staged_dir(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            return staged_object.list_dir(path)
+
+    # Gets the path to read a file in a staged object from
+    @timed("ocflpy.get_read_path")
+    def get_read_path(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            return staged_object.get_read_path(path)
+
+    # Gets the content key and the stored content file of a file in a staged object. Returns None
+    # for both if the file is read from staging
+    def get_stored_content(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            return staged_object.get_stored_content(path)
+
+    # Reads from a stored content file through the block cache
+    def read_stored_content(self,key,content_path,fd,size,offset,sequential=False):
+        return self.block_cache.read(key,content_path,fd,size,offset,sequential)
+
+    # Creates a write-back buffer for a file descriptor returned by open_staged_file for a path.
+    # Returns None if buffering is disabled
+    def open_write_buffer(self,id,fd,path):
+        return self.write_buffers.open(id,fd,path)
+
+    # Writes through a write-back buffer
+    def write_buffered(self,buffer,data,offset):
+        buffer.write(data,offset)
+        return len(data)
+
+    # Flushes a write-back buffer and closes it
+    @timed("ocflpy.close_write_buffer")
+    def close_write_buffer(self,buffer):
+        self.write_buffers.close(buffer)
+
+    # Flushes all write-back buffers of a staged object so the staged files are complete
+    @timed("ocflpy.flush_write_buffers")
+    def flush_write_buffers(self,id):
+        self.write_buffers.flush(id)
+
+    # Gets the path to write a file in a staged object to, copying it into staging first if necessary
+    @timed("ocflpy.get_write_path")
+    def get_write_path(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            return staged_object.materialize(path)
+
+    # Opens a file in a staged object and returns the OS file descriptor. Files opened for
+    # writing are copied into staging first and have to be closed with close_staged_file
+    @timed("ocflpy.open_staged_file")
+    def open_staged_file(self,id,path,flags):
+        accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+        if (flags & accmode) == os.O_RDONLY:
+            return os.open(self.get_read_path(id,path),os.O_RDONLY)
+        with self.lock_staged_object(id) as staged_object:
+            return staged_object.open_file(path,(flags & accmode) | (flags & os.O_TRUNC))
+
+    # Closes a file descriptor returned by open_staged_file, also after the object was committed
+    # or reverted
+    def close_staged_file(self,id,fd):
+        with self.staging_lock:
+            staged_object = self.staging_objects.get(id)
+        if staged_object is None:
+            os.close(fd)
+            return
+        with staged_object.lock:
+            staged_object.close_file(fd)
+
+    # Truncates a file in a staged object in place
+    @timed("ocflpy.truncate_staged_file")
+    def truncate_staged_file(self,id,path,length):
+        with self.lock_staged_object(id) as staged_object:
+            staged_object.truncate(path,length)
+
+    # Creates an empty file in a staged object
+    @timed("ocflpy.create_staged_file")
+    def create_staged_file(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            staged_object.create_file(path)
+
+    # Creates a directory in a staged object
+    @timed("ocflpy.make_staged_dir")
+    def make_staged_dir(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            staged_object.make_dir(path)
+
+    # Removes a file from a staged object
+    @timed("ocflpy.remove_staged_file")
+    def remove_staged_file(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            staged_object.remove_file(path)
+
+    # Removes an empty directory from a staged object
+    @timed("ocflpy.remove_staged_dir")
+    def remove_staged_dir(self,id,path):
+        with self.lock_staged_object(id) as staged_object:
+            staged_object.remove_dir(path)
+
+    # Renames a file or directory in a staged object
+    @timed("ocflpy.rename_staged_path")
+    def rename_staged_path(self,id,old_path,path):
+        with self.lock_staged_object(id) as staged_object:
+            staged_object.rename(old_path,path)
+            self.write_buffers.rename(id,old_path,path)
 
     # Get the path for an object id
     def get_object_path(self,id):
-        return os.path.join(self.root,self.store.object_path(id));
+        if id in self.object_paths:
+            return os.path.join(self.root,self.object_paths[id])
+        return os.path.join(self.root,self.store.object_path(id))
 
-    # Get the inventory for an object id
+    # Get the inventory for an object id. The inventory is shared with the cache and must not be changed
+    @timed("ocflpy.get_object_inventory")
     def get_object_inventory(self,id):
-        self.log.info("GET INVENTORY")
-        return json.load(open(os.path.join(self.get_object_path(id),"inventory.json"),"r"))
+        inventory_file = os.path.join(self.get_object_path(id),"inventory.json")
+        inventory = self.inventory_cache.get(id,inventory_file)
+        if inventory is None:
+            self.log.info("GET INVENTORY")
+            inventory = self.read_inventory(inventory_file)
+            self.inventory_cache.put(id,inventory_file,inventory)
+        return inventory
+
+    # Reads an inventory file bypassing the cache
+    def read_inventory(self,inventory_file):
+        with open(inventory_file,"r") as f:
+            return json.load(f)
 
     # List the files in the most recent version of an object given by its id
     def list_object_files(self,id):
@@ -89,13 +1902,68 @@ class OCFLPY():
             file_list=file_list+version_state[hash]
         return file_list
 
+    # Lists the versions of an object in the store
+    def list_object_versions(self,id):
+        if not self.has_object(id):
+            raise OCFLException("Object not in store " + id)
+        return sorted(self.get_object_inventory(id)['versions'].keys(),key=lambda v: int(v[1:]))
+
+    # Gets the read-only view of a version of an object in the store
+    @timed("ocflpy.get_version_tree")
+    def get_version_tree(self,id,version):
+        with self.version_lock:
+            tree = self.version_trees.get((id,version))
+            if tree is not None:
+                self.version_trees.move_to_end((id,version))
+                return tree
+        if not self.has_object(id):
+            raise OCFLException("Object not in store " + id)
+        inventory = self.get_object_inventory(id)
+        if version not in inventory['versions']:
+            raise OCFLException("Version " + version + " not in object " + id)
+        tree = ObjectTree.from_version(id,self.get_object_path(id),inventory,version)
+        with self.version_lock:
+            self.version_trees[(id,version)] = tree
+            while len(self.version_trees) > self.version_trees_size:
+                self.version_trees.popitem(last=False)
+        return tree
+
+    # Returns a tuple of is_dir, size and mtime for a path in a stored version or None if it does not exist
+    def stat_version_path(self,id,version,path):
+        return self.get_version_tree(id,version).stat(path)
+
+    # Lists a directory in a stored version
+    def list_version_dir(self,id,version,path):
+        return self.get_version_tree(id,version).list_dir(path)
+
+    # Gets the stored content file for a file in a stored version
+    def get_version_read_path(self,id,version,path):
+        return self.get_version_tree(id,version).get_read_path(path)
+
+    # Gets the content key and the stored content file for a file in a stored version
+    def get_version_stored_content(self,id,version,path):
+        return self.get_version_tree(id,version).get_stored_content(path)
+
     # Creates a new object, i.e. a new folder in staging
+    @timed("ocflpy.create_object")
     def create_object(self,id):
+        # Check if object already exists in store
+        if self.has_object(id):
+            raise OCFLException("Object already exists in store " + id)
         # Get a normalized id, i.e. without problematic special characters
         normalized_id = self.encode_id(id)
-        self.staging_objects[id] = normalized_id
-        os.mkdir(self.get_staging_object_path(id))
-        new_object = Object(identifier=id,path=self.get_staging_object_path(id))
+        staging_object = os.path.join(self.staging_dir,normalized_id)
+        with self.staging_lock:
+            # Check if object already exists in staging
+            if id in self.staging_objects:
+                raise OCFLException("Object already exists in staging " + id)
+            os.mkdir(staging_object)
+            staged_object = StagedObject(id,staging_object,time.time())
+            staged_object.start_journal(None)
+            staged_object.create_journal()
+            # A new object is a change in itself
+            staged_object.changed = True
+            self.staging_objects[id] = staged_object
         return 0
     #     # Get a normalized id, i.e. without problematic special characters
     #     normalized_id = self.encode_id(id)
@@ -111,67 +1979,734 @@ class OCFLPY():
     #     self.staging_objects[id] = normalized_id
 
     # Opens an existing object from the store and makes it available in staging
+    @timed("ocflpy.open_object")
     def open_object(self,id):
         # Check if object id is in store
-        if not(id in self.list_object_ids()):
+        if not self.has_object(id):
             raise OCFLException("Object not in store " + id)
         # Get a normalized id, i.e. without problematic special characters
+        # Nothing to do if the object is already staged
+        if self.is_staged(id):
+            return
+        self.stage_head_version(id)
+
+    # Stages the head version of a stored object. A staged object given as replaced is discarded
+    # in the same step, so the object is never missing from staging in between
+    def stage_head_version(self,id,replaced=None):
+        # Get a normalized id, i.e. without problematic special characters
         normalized_id = self.encode_id(id)
-        # Check if object is already in staging
+        # Build the view of the head version from the inventory without blocking other objects
         staging_object = os.path.join(self.staging_dir,normalized_id)
-        if not(id in self.staging_objects.keys()) and os.path.exists(staging_object):
-               raise OCFLException("Object folder already exists in staging")
+        object_path=self.get_object_path(id)
+        object_inventory=self.get_object_inventory(id)
+        staged_object = StagedObject.from_inventory(id,staging_object,object_path,object_inventory)
+        discarded_path = None
+        with self.staging_lock:
+            # Another thread may have staged or reverted the object in the meantime
+            if self.staging_objects.get(id) is not replaced:
+                return
+            if replaced is not None:
+                discarded_path = self.discard_staged_object(replaced)
+            # Check if object is already in staging
+            if os.path.exists(staging_object):
+                   raise OCFLException("Object folder already exists in staging")
+            self.log.info("Staging version %s from %s to %s", object_inventory['head'], object_path, staging_object)
+            staged_object.start_journal(object_inventory['head'])
+            # Add to list of staged objects, but keep it locked until all files are extracted
+            staged_object.lock.acquire()
+            self.staging_objects[id] = staged_object
+        try:
+            if discarded_path is not None:
+                shutil.rmtree(discarded_path)
+            # Extract all files right away unless they are copied lazily
+            if not self.lazy:
+                staged_object.materialize_all()
+        finally:
+            staged_object.lock.release()
+
+    # Returns the pool to compute digests in, either using threads or processes
+    def get_digest_pool(self):
+        with self.staging_lock:
+            if self.digest_pool is None:
+                if self.digest_processes:
+                    self.digest_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.digest_workers)
+                else:
+                    self.digest_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.digest_workers)
+            return self.digest_pool
+
+    # Computes the digests for a list of files in parallel. The digests are returned in the
+    # same order as the files. The optional progress function is called for each finished file.
+    # If a list of copies is given, each file is copied to the corresponding copy in the same pass
+    @timed("ocflpy.compute_digests")
+    def compute_digests(self,filenames,digest_algorithm,progress=None,copies=None):
+        if copies is not None:
+            function, args = copy_digest, (filenames,copies,[digest_algorithm] * len(filenames))
         else:
-            # Extract files
-            object_path=self.get_object_path(id)
-            object_inventory=self.get_object_inventory(id)
-            current_version=object_inventory['head']
-            current_object = Object(path=object_path)
-            self.log.info("Extracting version " + current_version + " from " + object_path + " to " + staging_object)
-            current_object.extract(object_path,current_version,staging_object)
-            # Convert stored creation time and remove the timezone Z marking UTC
-            creation_time = datetime.datetime.fromisoformat(object_inventory['versions'][current_version]['created'].replace("Z","")).timestamp()
-            # Update mtime
-            for root, dirs, files in os.walk(staging_object):
-                for f in dirs + files:
-                    file_name = os.path.join(root,f)
-                    stat = os.stat(file_name)
-                    os.utime(file_name, times=(stat.st_atime, creation_time))
-            # Add to list of staged objects            
-            self.staging_objects[id] = normalized_id
-
-    # Commit an object creating a new version
-    def commit_object(self,id,name,address):
-        self.log.info("OCFL COMMIT: " + id)
-        src_dir = self.get_staging_object_path(id)
-        # Create object from staging
-        object = Object(identifier=id)
-        # Create metadata for new version
-        creation_time = datetime.datetime.utcnow().isoformat()+"Z"
-        # Check if the ID is already in the store and create a new object if it is not yet in the store
-        if id not in self.list_object_ids():
-            # Convert the files in src_dir into an OCFL object in new_object
-            new_object = src_dir + "_obj"
-            metadata = VersionMetadata(created=creation_time,name=name,address=address, message="Created object " + id)
-            object.create(src_dir,metadata=metadata,objdir=new_object)
-            # Add the new object 
-            self.store.add(new_object)
-            shutil.rmtree(new_object)
-        # Update an object that is already in the store
+            function, args = compute_digest, (filenames,[digest_algorithm] * len(filenames))
+        if len(filenames) <= 1 or self.digest_workers <= 1:
+            digests = map(function,*args)
         else:
-            stored_object = os.path.join(self.root,self.store.object_path(id))
-            self.log.info("STORED OBJECT " + stored_object)
-            # Update object in store
-            metadata = VersionMetadata(created=creation_time,name=name,address=address, message="Updated object " + id)
-            object.update(stored_object,src_dir,metadata)
-        return 0
-    
-    # Revert a staged object
+            digests = self.get_digest_pool().map(function,*args)
+        result = []
+        for filename, digest in zip(filenames,digests):
+            result.append(digest)
+            if progress is not None:
+                progress(filename)
+        return result
+
+    # Returns a progress function for compute_digests updating the commit status of an object
+    def hashing_progress(self,id,filenames):
+        total = sum(os.path.getsize(filename) for filename in filenames)
+        hashed = 0
+        self.set_commit_status(id,"hashing 0/" + str(total) + " bytes")
+        def progress(filename):
+            nonlocal hashed
+            hashed += os.path.getsize(filename)
+            self.set_commit_status(id,"hashing " + str(hashed) + "/" + str(total) + " bytes")
+        return progress
+
+    # Adds a new version with the content of a staged object to an inventory. Only files
+    # changed in staging are hashed, all other files reuse the digest from the inventory
+    # they were staged from. Digests can also be computed beforehand and given as a map
+    # from the staged file to its digest. If a stream directory is given, the changed files are
+    # copied into it while they are hashed. Returns a map from the new content paths to the
+    # staged files or their copies
+    def add_staged_version(self,object,inventory,staged_object,vdir,metadata,digests=None,stream_dir=None):
+        digest_algorithm = inventory['digestAlgorithm']
+        manifest = inventory['manifest']
+        state = {}
+        manifest_to_srcfile = {}
+        # Hash all changed files in parallel that were not hashed before
+        changed_files = sorted(staged_object.list_changed_files())
+        digests = dict(digests) if digests is not None else {}
+        changed_paths = [staged_object.get_staged_path(path) for path in changed_files
+                         if staged_object.get_staged_path(path) not in digests]
+        copies = None
+        if stream_dir is not None:
+            copies = [os.path.join(stream_dir,str(i)) for i in range(len(changed_paths))]
+        changed_digests = self.compute_digests(changed_paths,digest_algorithm,
+                                               self.hashing_progress(staged_object.id,changed_paths),copies)
+        digests.update(zip(changed_paths,changed_digests))
+        copied = dict(zip(changed_paths,copies)) if copies is not None else {}
+        new_digests = {path: digests[staged_object.get_staged_path(path)] for path in changed_files}
+        # Merge the results in a fixed order
+        for path, digest in staged_object.list_files():
+            if digest is None:
+                digest = new_digests[path]
+            state.setdefault(digest,[]).append(path)
+            # New content has to be added to the manifest
+            if digest not in manifest:
+                vfilepath = object.map_filepath(path,vdir,used=manifest_to_srcfile)
+                manifest[digest] = [vfilepath]
+                staged_path = staged_object.get_staged_path(path)
+                manifest_to_srcfile[vfilepath] = copied.get(staged_path,staged_path)
+        # Extend the fixity blocks for the new content
+        for fixity_type, fixities in inventory.get('fixity',{}).items():
+            vfilepaths = sorted(manifest_to_srcfile.keys())
+            fixity_digests = self.compute_digests([manifest_to_srcfile[vfilepath] for vfilepath in vfilepaths],fixity_type)
+            for vfilepath, fixity_digest in zip(vfilepaths,fixity_digests):
+                fixities.setdefault(fixity_digest,[]).append(vfilepath)
+        inventory['head'] = vdir
+        inventory['versions'][vdir] = metadata.as_dict(state=state)
+        return manifest_to_srcfile
+
+    # Writes a new version of a staged object into the object directory opened in object. If
+    # staging and the object are on different file systems, changed files are copied into the
+    # new version while they are hashed, so each file is read only once
+    def write_staged_version(self,object,object_path,inventory,staged_object,metadata,digests=None):
+        vdir = next_version(inventory['head']) if 'head' in inventory else 'v1'
+        stream_dir = None
+        if not same_file_system(self.staging_dir,object_path):
+            stream_dir = os.path.join(object_path,vdir,"streaming")
+            os.makedirs(stream_dir)
+        manifest_to_srcfile = self.add_staged_version(object,inventory,staged_object,vdir,metadata,digests,stream_dir)
+        # Add the new content before any inventory refers to it. The staged files are removed
+        # after the commit, so they are linked instead of copied. Content already stored in
+        # another object is linked to the stored file if deduplication is enabled
+        self.set_commit_status(staged_object.id,"writing content")
+        digest_algorithm = inventory['digestAlgorithm']
+        new_digests = {paths[0]: digest for digest, paths in inventory['manifest'].items() if paths[0] in manifest_to_srcfile}
+        dedup_records = []
+        for vfilepath, srcfile in manifest_to_srcfile.items():
+            dstfile = os.path.join(object_path,vfilepath)
+            os.makedirs(os.path.dirname(dstfile),exist_ok=True)
+            saved = None
+            if self.dedup_index is not None and self.link_stored_content(digest_algorithm,new_digests[vfilepath],dstfile):
+                saved = os.path.getsize(dstfile)
+            elif stream_dir is not None and os.path.dirname(srcfile) == stream_dir:
+                os.rename(srcfile,dstfile)
+            else:
+                link_file(srcfile,dstfile)
+            dedup_records.append((digest_algorithm,new_digests[vfilepath],
+                                  os.path.relpath(os.path.join(self.get_object_path(staged_object.id),vfilepath),self.root),saved))
+        if stream_dir is not None:
+            shutil.rmtree(stream_dir)
+        # All content has to be on disk before an inventory refers to it
+        if self.sync_commits:
+            sync_paths([os.path.join(object_path,vfilepath) for vfilepath in manifest_to_srcfile] +
+                       sorted(set(os.path.dirname(os.path.join(object_path,vfilepath)) for vfilepath in manifest_to_srcfile)))
+        self.set_commit_status(staged_object.id,"writing inventory")
+        object.write_inventory_and_sidecar(inventory,vdir)
+        if vdir == 'v1':
+            object.write_object_declaration()
+        if self.sync_commits:
+            self.sync_inventory(object_path,vdir,digest_algorithm)
+        # The root inventory is written last and makes the new version visible
+        object.write_inventory_and_sidecar(inventory)
+        if self.sync_commits:
+            self.sync_inventory(object_path,"",digest_algorithm)
+        if self.dedup_index is not None:
+            self.dedup_index.add(dedup_records)
+        return vdir
+
+    # Writes an inventory, its sidecar and the directory entries to disk
+    def sync_inventory(self,object_path,vdir,digest_algorithm):
+        inventory_dir = os.path.join(object_path,vdir)
+        sync_paths([os.path.join(inventory_dir,"inventory.json"),
+                    os.path.join(inventory_dir,"inventory.json." + digest_algorithm),
+                    inventory_dir,object_path])
+
+    # Moves a new object into the store and falls back to copying it if the staging directory
+    # is on a different file system
+    def add_new_object(self,id,new_object):
+        object_path = os.path.join(self.root,self.store.object_path(id))
+        with self.store_lock:
+            if os.path.exists(object_path):
+                raise OCFLException("Object already exists in store " + id)
+            os.makedirs(os.path.dirname(object_path),exist_ok=True)
+            try:
+                os.rename(new_object,object_path)
+                if self.sync_commits:
+                    sync_paths([os.path.dirname(object_path)])
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            self.store.add(new_object)
+        shutil.rmtree(new_object)
+
+    # Creates the directory of a new object in the store to write the object into directly
+    def create_object_dir(self,id):
+        object_path = os.path.join(self.root,self.store.object_path(id))
+        with self.store_lock:
+            os.makedirs(os.path.dirname(object_path),exist_ok=True)
+            try:
+                os.mkdir(object_path)
+            except FileExistsError:
+                raise OCFLException("Object already exists in store " + id)
+        return object_path
+
+    # Commit an object creating a new version. Digests of changed files can be given if they were
+    # computed beforehand. Returns the new version
+    @timed("ocflpy.commit_object")
+    def commit_object(self,id,name,address,digests=None):
+        self.log.info("OCFL COMMIT: %s", id)
+        # Buffered writes have to be in the staged files before they are read
+        self.flush_write_buffers(id)
+        # Files still open for writing could change after they are hashed, so the commit waits
+        # until they are closed
+        with self.lock_staged_object(id,self.writers_timeout) as staged_object:
+            # Create metadata for new version
+            creation_time = datetime.datetime.utcnow().isoformat()+"Z"
+            # Check if the ID is already in the store and create a new object if it is not yet in the store
+            if not self.has_object(id):
+                # A commit interrupted from here on is finished or rolled back when the journal is replayed
+                staged_object.write_journal({"op": "commit", "version": "v1"})
+                # Write the staged files as an OCFL object into new_object and move it into the
+                # store. If staging is on a different file system the object is written directly
+                # into the store, so the content is not copied twice
+                if same_file_system(self.staging_dir,self.root):
+                    new_object = staged_object.staging_path + "_obj"
+                else:
+                    new_object = self.create_object_dir(id)
+                try:
+                    object = Object(identifier=id,path=new_object,create=True)
+                    metadata = VersionMetadata(created=creation_time,name=name,address=address, message="Created object " + id)
+                    vdir = self.write_staged_version(object,new_object,object.start_inventory(),staged_object,metadata,digests)
+                    # Add the new object
+                    if new_object != self.get_object_path(id):
+                        self.add_new_object(id,new_object)
+                except Exception:
+                    # Never leave an incomplete object behind
+                    if os.path.isdir(new_object) and (new_object != self.get_object_path(id) or
+                                                      not os.path.exists(os.path.join(new_object,"inventory.json"))):
+                        shutil.rmtree(new_object)
+                    raise
+                self.add_to_index(id)
+            # Update an object that is already in the store
+            else:
+                stored_object = self.get_object_path(id)
+                self.log.info("STORED OBJECT %s", stored_object)
+                # Read a private copy of the inventory because it is changed for the new version
+                inventory = self.read_inventory(os.path.join(stored_object,"inventory.json"))
+                new_version = next_version(inventory['head'])
+                staged_object.write_journal({"op": "commit", "version": new_version})
+                object = Object(identifier=id,digest_algorithm=inventory['digestAlgorithm'],path=stored_object)
+                # Update object in store
+                metadata = VersionMetadata(created=creation_time,name=name,address=address, message="Updated object " + id)
+                try:
+                    vdir = self.write_staged_version(object,stored_object,inventory,staged_object,metadata,digests)
+                except Exception:
+                    # Remove the incomplete version unless the root inventory already refers to it
+                    version_path = os.path.join(stored_object,new_version)
+                    if os.path.isdir(version_path) and \
+                       self.read_inventory(os.path.join(stored_object,"inventory.json"))['head'] != new_version:
+                        shutil.rmtree(version_path)
+                    raise
+                # The new inventory replaces the cached one right away
+                self.inventory_cache.put(id,os.path.join(stored_object,"inventory.json"),inventory)
+            # Stage the new head version again
+            self.stage_head_version(id,staged_object)
+        return vdir
+
+    # Gets the digest algorithm used for an object
+    def get_digest_algorithm(self,id):
+        if self.has_object(id):
+            return self.get_object_inventory(id)['digestAlgorithm']
+        return Object(identifier=id).digest_algorithm
+
+    # Commits a list of staged objects in one pass. The changed files of all objects are hashed
+    # together and the directories for all new objects are created at once. Returns a map from
+    # object id to the outcome of its commit
+    @timed("ocflpy.ingest_objects")
+    def ingest_objects(self,ids,name,address):
+        results = {}
+        staged_objects = {}
+        # Lock all objects in a fixed order
+        try:
+            for id in sorted(set(ids)):
+                try:
+                    staged_object = self.acquire_staged_object(id)
+                except OCFLException as e:
+                    results[id] = "error: " + str(e)
+                    continue
+                # Holding all locks the files still open for writing cannot be closed, so
+                # these objects are skipped instead of waited for
+                if staged_object.open_files:
+                    staged_object.lock.release()
+                    results[id] = "error: Object has files open for writing " + id
+                else:
+                    staged_objects[id] = staged_object
+            # Hash the changed files of all objects grouped by digest algorithm
+            changed_paths = {}
+            for id, staged_object in staged_objects.items():
+                self.set_commit_status(id,"hashing")
+                self.flush_write_buffers(id)
+                changed_paths.setdefault(self.get_digest_algorithm(id),[]).extend(
+                    staged_object.get_staged_path(path) for path in staged_object.list_changed_files())
+            # Files on a different file system than the store are hashed while they are copied
+            digests = {}
+            if same_file_system(self.staging_dir,self.root):
+                for digest_algorithm, paths in changed_paths.items():
+                    digests.update(zip(paths,self.compute_digests(paths,digest_algorithm)))
+            # Create the parent directories of all new objects in the store
+            new_ids = [id for id in staged_objects if not self.has_object(id)]
+            for parent in sorted(set(os.path.dirname(os.path.join(self.root,self.store.object_path(id))) for id in new_ids)):
+                os.makedirs(parent,exist_ok=True)
+            for id in staged_objects:
+                try:
+                    results[id] = "done at " + self.commit_object(id,name,address,digests)
+                except Exception as e:
+                    self.log.error("Commit of %s failed: %s", id, e)
+                    results[id] = "error: " + str(e)
+                self.set_commit_status(id,results[id])
+        finally:
+            for staged_object in staged_objects.values():
+                staged_object.lock.release()
+        return results
+
+    # Sets the status of the most recent commit of an object
+    def set_commit_status(self,id,status):
+        with self.commit_lock:
+            self.commit_status[id] = status
+
+    # Gets the status of the most recent commit of an object or None if it was never committed
+    def get_commit_status(self,id):
+        with self.commit_lock:
+            return self.commit_status.get(id)
+
+    # Checks if a commit of an object is queued or running
+    def is_committing(self,id):
+        with self.commit_lock:
+            return id in self.commit_futures
+
+    # Queues a commit of an object to run in the background. The optional callback is called
+    # with the object id once the commit is finished. Nothing is queued if the object is
+    # already waiting to be committed
+    def queue_commit(self,id,name,address,callback=None):
+        self.get_staged_object(id)
+        with self.commit_lock:
+            if id in self.commit_futures:
+                return
+            self.commit_status[id] = "queued"
+            self.commit_futures[id] = self.commit_pool.submit(self.run_commit,id,name,address,callback)
+
+    # Runs a queued commit and records its outcome
+    def run_commit(self,id,name,address,callback):
+        try:
+            status = "done at " + self.commit_object(id,name,address)
+        except Exception as e:
+            self.log.error("Commit of %s failed: %s", id, e)
+            status = "error: " + str(e)
+        with self.commit_lock:
+            self.commit_status[id] = status
+            del self.commit_futures[id]
+        if callback is not None:
+            callback(id)
+
+    # Queues an ingest of a list of staged objects to run in the background. The optional
+    # callback is called with the object ids once the ingest is finished. Objects already
+    # waiting to be committed are skipped
+    def queue_ingest(self,ids,name,address,callback=None):
+        with self.commit_lock:
+            ids = [id for id in ids if id not in self.commit_futures]
+            future = self.commit_pool.submit(self.run_ingest,ids,name,address,callback)
+            for id in ids:
+                self.commit_status[id] = "queued"
+                self.commit_futures[id] = future
+
+    # Runs a queued ingest and records its outcome
+    def run_ingest(self,ids,name,address,callback):
+        try:
+            results = self.ingest_objects(ids,name,address)
+        except Exception as e:
+            self.log.error("Ingest failed: %s", e)
+            results = {id: "error: " + str(e) for id in ids}
+        with self.commit_lock:
+            self.ingest_results = results
+            for id in ids:
+                self.commit_status[id] = results[id]
+                del self.commit_futures[id]
+        if callback is not None:
+            callback(ids)
+
+    # Gets the outcome of the most recent ingest as a map from object id to its status
+    def get_ingest_results(self):
+        with self.commit_lock:
+            return dict(self.ingest_results)
+
+    # Waits for all queued commits to finish. Staged objects without changes are removed from
+    # staging, all others are kept and adopted again on the next start
+    def shutdown(self):
+        if self.fixity_checker is not None:
+            self.fixity_checker.stop()
+        self.commit_pool.shutdown(wait=True)
+        with self.staging_lock:
+            unchanged = [id for id, staged_object in self.staging_objects.items() if not staged_object.changed]
+        for id in unchanged:
+            self.unstage_object(id)
+        # Merge the objects added since the mount into the index file
+        if self.index_file is not None and os.path.exists(self.get_index_log_path()):
+            self.save_index()
+
+    # Revert a staged object. Objects can not be reverted while they are committed
+    @timed("ocflpy.revert_object")
     def revert_object(self,id):
-        # Check if the object is actually staged
-        if id in self.staging_objects:
-            # Just remove the complete folder from staging
-            shutil.rmtree(self.get_staging_object_path(id))
-            # Also remove the ide from staging objects
-            self.staging_objects.pop(id)
+        if self.is_committing(id):
+            raise OCFLException("Object is being committed " + id)
+        return self.unstage_object(id)
+
+    # Removes an object from staging discarding all changes
+    def unstage_object(self,id):
+        # Check if the object is actually staged and remove it from the staging objects
+        try:
+            with self.lock_staged_object(id) as staged_object:
+                with self.staging_lock:
+                    discarded_path = self.discard_staged_object(staged_object)
+        except OCFLException:
+            return 0
+        if discarded_path is not None:
+            shutil.rmtree(discarded_path)
         return 0
+
+    # Removes a staged object from the staging objects and moves its folder out of the way, so
+    # the object can be staged again right away. Has to be called holding the staging lock and
+    # the lock of the object. Returns the folder to remove or None if nothing was staged on disk
+    def discard_staged_object(self,staged_object):
+        del self.staging_objects[staged_object.id]
+        staged_object.remove_journal()
+        if not os.path.isdir(staged_object.staging_path):
+            return None
+        # Leftovers of a crash have no journal and are removed on the next start
+        discarded_path = tempfile.mkdtemp(prefix=".discarded-",dir=self.staging_dir)
+        os.rename(staged_object.staging_path,os.path.join(discarded_path,"object"))
+        return discarded_path
+
+# Creates a method of ShardedOCFLPY calling the method of the same name of the shard holding
+# the object id given as first argument
+def routed(name):
+    def method(self,id,*args,**kw):
+        return getattr(self.get_shard(id),name)(id,*args,**kw)
+    method.__name__ = name
+    return method
+
+# Presents several OCFL storage roots, e.g. on different disks, as one store. Each root is
+# wrapped in its own OCFLPY with its own staging directory, index, caches and worker pools,
+# so reads and commits on different roots do not wait for each other. New object ids are
+# assigned to a root by a hash of the id or by the longest matching prefix, existing objects
+# are found in whichever root holds them
+class ShardedOCFLPY():
+
+    encode_id = OCFLPY.encode_id
+    decode_id = OCFLPY.decode_id
+
+    def __init__(self,roots,staging_dirs,disposition,shard_rule="hash",shard_prefixes=None,**options):
+        if len(roots) == 0:
+            raise OCFLException("No OCFL storage root given")
+        if shard_rule not in ["hash", "prefix"]:
+            raise OCFLException("Unknown shard rule " + shard_rule)
+        if shard_rule == "prefix" and (shard_prefixes is None or len(shard_prefixes) != len(roots)):
+            raise OCFLException("One prefix per storage root is needed")
+        # A single staging directory is split into one subdirectory per root
+        if len(staging_dirs) == 1 and len(roots) > 1:
+            if not os.path.exists(staging_dirs[0]):
+                os.mkdir(staging_dirs[0])
+            staging_dirs = [os.path.join(staging_dirs[0],str(i)) for i in range(len(roots))]
+        if len(staging_dirs) != len(roots):
+            raise OCFLException("One staging directory per storage root is needed")
+        self.shard_rule = shard_rule
+        self.shard_prefixes = shard_prefixes
+        self.metrics = Metrics()
+        self.dispositor = Dispositor()
+        # Memory limits are shared by all roots, files kept between mounts exist once per root
+        options = dict(options)
+        for option in ["block_cache_size", "write_buffer_limit"]:
+            if option in options:
+                options[option] = options[option] // len(roots)
+        self.shards = []
+        for i, (root, staging_dir) in enumerate(zip(roots,staging_dirs)):
+            shard_options = dict(options)
+            for option in ["index_file", "dedup_index", "fixity_state"]:
+                if shard_options.get(option) is not None:
+                    shard_options[option] = shard_options[option] + "." + str(i)
+            self.shards.append(OCFLPY(root,staging_dir,disposition,**shard_options))
+        # Shards holding the objects of the most recent ingest
+        self.ingest_shards = []
+
+    # Gets the shard a new object id is assigned to
+    def route(self,id):
+        if self.shard_rule == "hash":
+            digest = hashlib.sha256(id.encode('utf-8')).digest()
+            return self.shards[int.from_bytes(digest[:8],'big') % len(self.shards)]
+        matches = [(len(prefix), i) for i, prefix in enumerate(self.shard_prefixes) if id.startswith(prefix)]
+        if not matches:
+            raise OCFLException("No storage root for object id " + id)
+        return self.shards[max(matches)[1]]
+
+    # Gets the shard holding an object, either staged or stored, or the shard a new object is assigned to
+    def get_shard(self,id):
+        for shard in self.shards:
+            if shard.is_staged(id) or shard.has_object(id):
+                return shard
+        return self.route(id)
+
+    # Gets the shard holding a stored content file
+    def get_content_shard(self,content_path):
+        for shard in self.shards:
+            if content_path.startswith(os.path.join(shard.root,"")):
+                return shard
+        raise OCFLException("Content file not in any storage root " + content_path)
+
+    get_staged_object = routed("get_staged_object")
+    get_staging_object_path = routed("get_staging_object_path")
+    stat_staged_path = routed("stat_staged_path")
+    list_staged_dir = routed("list_staged_dir")
+    get_read_path = routed("get_read_path")
+    get_stored_content = routed("get_stored_content")
+    open_write_buffer = routed("open_write_buffer")
+    flush_write_buffers = routed("flush_write_buffers")
+    get_write_path = routed("get_write_path")
+    open_staged_file = routed("open_staged_file")
+    truncate_staged_file = routed("truncate_staged_file")
+    close_staged_file = routed("close_staged_file")
+    create_staged_file = routed("create_staged_file")
+    make_staged_dir = routed("make_staged_dir")
+    remove_staged_file = routed("remove_staged_file")
+    remove_staged_dir = routed("remove_staged_dir")
+    rename_staged_path = routed("rename_staged_path")
+    get_object_path = routed("get_object_path")
+    get_object_inventory = routed("get_object_inventory")
+    list_object_files = routed("list_object_files")
+    list_object_versions = routed("list_object_versions")
+    get_version_tree = routed("get_version_tree")
+    stat_version_path = routed("stat_version_path")
+    list_version_dir = routed("list_version_dir")
+    get_version_read_path = routed("get_version_read_path")
+    get_version_stored_content = routed("get_version_stored_content")
+    create_object = routed("create_object")
+    open_object = routed("open_object")
+    commit_object = routed("commit_object")
+    get_digest_algorithm = routed("get_digest_algorithm")
+    get_commit_status = routed("get_commit_status")
+    is_committing = routed("is_committing")
+    queue_commit = routed("queue_commit")
+    revert_object = routed("revert_object")
+    unstage_object = routed("unstage_object")
+
+    # Starts indexing all roots in the background
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    # Waits for the queued commits of all roots at the same time
+    def shutdown(self):
+        threads = [threading.Thread(target=shard.shutdown) for shard in self.shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # Waits until the object indexes of all roots are complete
+    def wait_for_index(self,timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for shard in self.shards:
+            if not shard.wait_for_index(max(deadline - time.monotonic(),0) if deadline is not None else None):
+                return False
+        return True
+
+    # Checks if an object id is in any of the roots
+    def has_object(self,id):
+        return any(shard.has_object(id) for shard in self.shards)
+
+    # Checks if an object is staged in any of the roots
+    def is_staged(self,id):
+        return any(shard.is_staged(id) for shard in self.shards)
+
+    # Returns the sorted list of all object ids merged from the indexes of all roots
+    def list_object_ids(self):
+        return list(heapq.merge(*[shard.list_object_ids() for shard in self.shards]))
+
+    # Returns the number of objects in all roots
+    def count_object_ids(self):
+        return sum(shard.count_object_ids() for shard in self.shards)
+
+    # Returns the position of the first object id following an id in the merged list of all object ids
+    def get_object_id_position(self,id):
+        return sum(shard.get_object_id_position(id) for shard in self.shards)
+
+    # Returns the positions in the index of each root where the merged list reaches a position. The
+    # id at that position is searched for in each root, comparing its position in its own root
+    # and the number of ids sorting before it in all other roots. Returns None if there is no
+    # exact match
+    def get_shard_positions(self,start):
+        counts = [shard.count_object_ids() for shard in self.shards]
+        for i, shard in enumerate(self.shards):
+            low, high = 0, counts[i]
+            while low < high:
+                middle = (low + high) // 2
+                id = shard.get_object_id(middle)
+                before = [other.count_object_ids_before(id) if j != i else middle for j, other in enumerate(self.shards)]
+                if sum(before) < start:
+                    low = middle + 1
+                elif sum(before) > start:
+                    high = middle
+                else:
+                    return before
+        # Only ids stored in several roots prevent an exact match
+        if start < sum(counts):
+            return None
+        return counts
+
+    # Iterates over the sorted object ids of all roots starting at a position of the merged list.
+    # The indexes are merged while they are read, so the complete list is never built
+    def iter_object_ids(self,start=0,chunk_size=1000):
+        self.wait_for_index()
+        positions = self.get_shard_positions(start)
+        if positions is None:
+            merged = heapq.merge(*[shard.iter_object_ids(0,chunk_size) for shard in self.shards])
+            yield from itertools.islice(merged,start,None)
+            return
+        yield from heapq.merge(*[shard.iter_object_ids(position,chunk_size)
+                                 for shard, position in zip(self.shards,positions)])
+
+    # Returns the list of all new objects that are staged but not yet in the store
+    def list_new_object_ids(self):
+        return [id for shard in self.shards for id in shard.list_new_object_ids()]
+
+    # Reads from a stored content file through the block cache of its root
+    def read_stored_content(self,key,content_path,fd,size,offset,sequential=False):
+        return self.get_content_shard(content_path).read_stored_content(key,content_path,fd,size,offset,sequential)
+
+    # Writes through a write-back buffer
+    def write_buffered(self,buffer,data,offset):
+        buffer.write(data,offset)
+        return len(data)
+
+    # Flushes a write-back buffer and closes it
+    def close_write_buffer(self,buffer):
+        self.get_shard(buffer.id).close_write_buffer(buffer)
+
+    # Splits a list of object ids by the shards holding them
+    def split_object_ids(self,ids):
+        shard_ids = collections.OrderedDict()
+        for id in ids:
+            shard_ids.setdefault(self.get_shard(id),[]).append(id)
+        return shard_ids
+
+    # Commits a list of staged objects, the objects of each root are ingested in parallel
+    def ingest_objects(self,ids,name,address):
+        shard_ids = self.split_object_ids(ids)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(shard_ids),1)) as pool:
+            futures = [pool.submit(shard.ingest_objects,ids,name,address) for shard, ids in shard_ids.items()]
+            results = {}
+            for future in futures:
+                results.update(future.result())
+        return results
+
+    # Queues an ingest of a list of staged objects on the commit queue of each root. The callback
+    # is called once for the objects of each root
+    def queue_ingest(self,ids,name,address,callback=None):
+        shard_ids = self.split_object_ids(ids)
+        self.ingest_shards = list(shard_ids)
+        for shard, ids in shard_ids.items():
+            shard.queue_ingest(ids,name,address,callback)
+
+    # Gets the outcome of the most recent ingest as a map from object id to its status
+    def get_ingest_results(self):
+        results = {}
+        for shard in self.ingest_shards:
+            results.update(shard.get_ingest_results())
+        return results
+
+    # Returns the metrics of the file system operations and the statistics of each root
+    def get_stats(self):
+        stats = self.metrics.snapshot()
+        stats["index_ready"] = all(shard.index_ready.is_set() for shard in self.shards)
+        stats["shards"] = {shard.root: shard.get_stats() for shard in self.shards}
+        return stats
+
+    # Returns the deduplication statistics summed over all roots or None if deduplication is disabled
+    def dedup_stats(self):
+        all_stats = [stats for stats in (shard.dedup_stats() for shard in self.shards) if stats is not None]
+        if not all_stats:
+            return None
+        return {key: sum(stats[key] for stats in all_stats) for key in all_stats[0]}
+
+    # Returns the validation status of each root in one line and the findings of all roots, or None
+    # if the store is not validated
+    def get_validation_status(self):
+        if self.shards[0].get_validation_status() is None:
+            return None
+        statuses, findings = [], []
+        for shard in self.shards:
+            status, shard_findings = shard.get_validation_status()
+            statuses.append(shard.root + ": " + status)
+            findings.extend(shard_findings)
+        return "\n".join(statuses), findings
+
+    # Returns the state of the fixity checks of all roots combined, or None if it is not enabled
+    def get_fixity_status(self):
+        states = [shard.get_fixity_status() for shard in self.shards]
+        if states[0] is None:
+            return None
+        started = [state["started"] for state in states if state["started"] is not None]
+        finished = [state["finished"] for state in states]
+        positions = [state["position"] for state in states if state["position"] is not None]
+        status = {"pass": min(state["pass"] for state in states),
+                  "started": min(started) if started else None,
+                  "finished": max(finished) if None not in finished else None,
+                  "position": " ".join(positions) if positions else None,
+                  "findings": [finding for state in states for finding in state["findings"]]}
+        for key in ["objects", "files", "bytes", "failures"]:
+            status[key] = sum(state[key] for state in states)
+        return status
@@ -0,0 +1,71 @@
+import os
+import sys
+import shutil
+import tempfile
+import importlib.util
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The file system script is not a module name, so it is loaded from its path
+spec = importlib.util.spec_from_file_location("ocfl_fuse", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ocfl-fuse.py"))
+ocfl_fuse = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ocfl_fuse)
+
+from ocfl_wrapper import OCFLPY
+
+USER = "tester"
+ADDRESS = "mailto:tester@localhost"
+
+class AttrCacheTest(unittest.TestCase):
+
+    # Invalidating a tree hides everything cached below it but nothing beside it
+    def test_invalidate_tree(self):
+        cache = ocfl_fuse.AttrCache(60)
+        for path in ["/objects", "/objects/a", "/objects/a/x", "/objects/a/x/y", "/objects/ab"]:
+            cache.put_attr(path, path)
+            cache.put_entries(path, [path])
+        cache.invalidate_tree("/objects/a")
+        for path in ["/objects/a", "/objects/a/x", "/objects/a/x/y"]:
+            self.assertIsNone(cache.get_attr(path))
+            self.assertIsNone(cache.get_entries(path))
+        self.assertEqual(cache.get_attr("/objects/ab"), "/objects/ab")
+        self.assertEqual(cache.get_attr("/objects"), "/objects")
+        self.assertIsNone(cache.get_entries("/objects"))
+        # Entries cached after the invalidation are used again
+        cache.put_attr("/objects/a/x", "new")
+        self.assertEqual(cache.get_attr("/objects/a/x"), "new")
+
+class FileSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = ocfl_fuse.OCFLFS()
+        self.server.attr_cache = ocfl_fuse.AttrCache(60)
+        self.server.ocflpy = OCFLPY(os.path.join(self.tmp, "store"), os.path.join(self.tmp, "staging"), disposition='pairtree')
+        self.server.metrics = self.server.ocflpy.metrics
+        self.assertTrue(self.server.ocflpy.wait_for_index(10))
+
+    def tearDown(self):
+        self.server.ocflpy.shutdown()
+        shutil.rmtree(self.tmp)
+
+    # Lists a directory starting at an offset as the kernel does
+    def readdir(self, path, offset):
+        return [(entry.name, entry.offset) for entry in self.server.readdir(path, offset)]
+
+    # Listings continued at any offset return the remaining entries with their positions
+    def test_readdir_offset(self):
+        for object_id in ["a", "b", "c"]:
+            self.server.ocflpy.create_object(object_id)
+            self.server.ocflpy.commit_object(object_id, USER, ADDRESS)
+        self.server.ocflpy.create_object("new")
+        for path, names in [("/objects", [".", "..", "a", "b", "c", "new"]),
+                            ("/versions", [".", "..", "a", "b", "c"])]:
+            entries = self.readdir(path, 0)
+            self.assertEqual(entries, [(name, position) for position, name in enumerate(names, start=1)])
+            for offset in range(len(names) + 1):
+                self.assertEqual(self.readdir(path, offset), entries[offset:])
+
+if __name__ == '__main__':
+    unittest.main()
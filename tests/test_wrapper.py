@@ -0,0 +1,334 @@
+import os
+import errno
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocfl import Validator
+from ocfl_wrapper import OCFLPY, ShardedOCFLPY, OCFLException, copy_file_data
+
+USER = "tester"
+ADDRESS = "mailto:tester@localhost"
+
+class WrapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "store")
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree')
+
+    def tearDown(self):
+        self.ocflpy.shutdown()
+        shutil.rmtree(self.tmp)
+
+    # Writes the content of a file in a staged object
+    def write_file(self, object_id, path, data):
+        fd = self.ocflpy.open_staged_file(object_id, path, os.O_WRONLY | os.O_TRUNC)
+        try:
+            os.write(fd, data)
+        finally:
+            self.ocflpy.close_staged_file(object_id, fd)
+
+    # Simulates a crash by starting a new wrapper on the same store and staging area without
+    # shutting down the old one
+    def restart(self):
+        self.ocflpy.commit_pool.shutdown()
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree')
+
+    # Checks that the object and the digests of its content are valid
+    def assert_valid(self, object_id):
+        validator = Validator(check_digests=True, show_warnings=False)
+        self.assertTrue(validator.validate(self.ocflpy.get_object_path(object_id)), str(validator))
+
+    # Commits wait for files open for writing to be closed, so the committed content cannot change
+    def test_commit_with_open_file(self):
+        self.ocflpy.writers_timeout = 0.2
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x.txt")
+        self.write_file("obj", "x.txt", b"hello")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        fd = self.ocflpy.open_staged_file("obj", "x.txt", os.O_WRONLY)
+        try:
+            os.pwrite(fd, b"world", 0)
+            with self.assertRaises(OCFLException):
+                self.ocflpy.commit_object("obj", USER, ADDRESS)
+            self.assertEqual(self.ocflpy.ingest_objects(["obj"], USER, ADDRESS),
+                             {"obj": "error: Object has files open for writing obj"})
+        finally:
+            self.ocflpy.close_staged_file("obj", fd)
+        self.assertEqual(self.ocflpy.commit_object("obj", USER, ADDRESS), "v2")
+        self.assert_valid("obj")
+        with open(self.ocflpy.get_read_path("obj", "x.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"world")
+
+    # Changes waiting for the lock of an object while it is committed go to the new staged object
+    def test_change_during_commit(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        with self.ocflpy.lock_staged_object("obj"):
+            thread = threading.Thread(target=self.ocflpy.create_staged_file, args=("obj", "x"))
+            thread.start()
+            thread.join(0.1)
+            self.ocflpy.commit_object("obj", USER, ADDRESS)
+        thread.join()
+        self.assertIsNotNone(self.ocflpy.stat_staged_path("obj", "x"))
+        self.ocflpy.revert_object("obj")
+        self.ocflpy.open_object("obj")
+        self.assertIsNone(self.ocflpy.stat_staged_path("obj", "x"))
+
+    # Staged changes are adopted again after a crash
+    def test_recover_staged_changes(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x")
+        self.write_file("obj", "x", b"stored")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.write_file("obj", "x", b"staged")
+        self.ocflpy.make_staged_dir("obj", "dir")
+        self.ocflpy.rename_staged_path("obj", "x", "dir/y")
+        self.restart()
+        self.assertTrue(self.ocflpy.is_staged("obj"))
+        self.assertEqual(self.ocflpy.list_staged_dir("obj", ""), ["dir"])
+        with open(self.ocflpy.get_read_path("obj", "dir/y"), "rb") as f:
+            self.assertEqual(f.read(), b"staged")
+        self.assertEqual(self.ocflpy.commit_object("obj", USER, ADDRESS), "v2")
+        self.assert_valid("obj")
+
+    # An incomplete version is removed after a crash and the staged changes are kept
+    def test_recover_partial_version(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x")
+        self.write_file("obj", "x", b"stored")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.write_file("obj", "x", b"staged")
+        self.ocflpy.get_staged_object("obj").write_journal({"op": "commit", "version": "v2"})
+        version_path = os.path.join(self.ocflpy.get_object_path("obj"), "v2")
+        os.makedirs(os.path.join(version_path, "content"))
+        with open(os.path.join(version_path, "content", "x"), "wb") as f:
+            f.write(b"sta")
+        self.restart()
+        self.assertFalse(os.path.exists(version_path))
+        self.assert_valid("obj")
+        with open(self.ocflpy.get_read_path("obj", "x"), "rb") as f:
+            self.assertEqual(f.read(), b"staged")
+        self.assertEqual(self.ocflpy.commit_object("obj", USER, ADDRESS), "v2")
+        self.assert_valid("obj")
+
+    # A commit interrupted after the root inventory was written is finished after a crash
+    def test_recover_finished_commit(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x")
+        self.write_file("obj", "x", b"content")
+        def crash(*args):
+            raise RuntimeError("crash")
+        self.ocflpy.stage_head_version = crash
+        with self.assertRaises(RuntimeError):
+            self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.restart()
+        self.assertFalse(self.ocflpy.is_staged("obj"))
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "staging")), [])
+        self.assertTrue(self.ocflpy.wait_for_index(10))
+        self.assertEqual(self.ocflpy.list_object_ids(), ["obj"])
+        self.assertEqual(self.ocflpy.list_object_versions("obj"), ["v1"])
+        self.assert_valid("obj")
+
+    # Objects that are only browsed create neither a journal nor a folder in staging
+    def test_browse_without_staging(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.assertTrue(self.ocflpy.is_staged("obj"))
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "staging")), [])
+        self.ocflpy.create_staged_file("obj", "x")
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp, "staging"))), ["obj", "obj.journal"])
+
+    # Unreadable objects are skipped and reported, and an index that fails still lets listings finish
+    def test_index_errors(self):
+        for object_id in ["a", "b"]:
+            self.ocflpy.create_object(object_id)
+            self.ocflpy.commit_object(object_id, USER, ADDRESS)
+        with open(os.path.join(self.ocflpy.get_object_path("b"), "inventory.json"), "w") as f:
+            f.write("{")
+        self.ocflpy.shutdown()
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree', validate=True)
+        self.assertTrue(self.ocflpy.wait_for_index(10))
+        self.assertEqual(self.ocflpy.list_object_ids(), ["a"])
+        self.ocflpy.background_init.join(10)
+        status, findings = self.ocflpy.get_validation_status()
+        self.assertEqual(status, "done: 2 objects checked, 1 invalid")
+        self.assertIn("cannot read inventory", findings[0])
+        self.ocflpy.shutdown()
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree', start=False)
+        def fail():
+            raise OSError(errno.EIO, "I/O error")
+        self.ocflpy.scan_store = fail
+        self.ocflpy.init_in_background(False, False)
+        self.assertTrue(self.ocflpy.wait_for_index(0))
+        self.assertIsNotNone(self.ocflpy.get_stats()["index_error"])
+        self.assertTrue(self.ocflpy.has_object("a"))
+
+    # Ingesting commits all staged objects and reports objects that are not staged
+    def test_ingest_objects(self):
+        self.ocflpy.create_object("old")
+        self.ocflpy.create_staged_file("old", "x")
+        self.write_file("old", "x", b"old")
+        self.ocflpy.commit_object("old", USER, ADDRESS)
+        self.write_file("old", "x", b"changed")
+        for object_id in ["a", "b"]:
+            self.ocflpy.create_object(object_id)
+            self.ocflpy.create_staged_file(object_id, "x")
+            self.write_file(object_id, "x", object_id.encode())
+        results = self.ocflpy.ingest_objects(["a", "b", "old", "missing"], USER, ADDRESS)
+        self.assertEqual(results, {"a": "done at v1", "b": "done at v1", "old": "done at v2",
+                                   "missing": "error: Object not staged missing"})
+        self.assertEqual(self.ocflpy.list_object_ids(), ["a", "b", "old"])
+        for object_id, content in [("a", b"a"), ("b", b"b"), ("old", b"changed")]:
+            self.assert_valid(object_id)
+            self.assertEqual(self.ocflpy.get_commit_status(object_id), results[object_id])
+            with open(self.ocflpy.get_read_path(object_id, "x"), "rb") as f:
+                self.assertEqual(f.read(), content)
+
+    # Files closed before the commit are still committed correctly
+    def test_commit_closed_files(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "a")
+        self.write_file("obj", "a", b"first")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.write_file("obj", "a", b"second")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.assert_valid("obj")
+        self.assertEqual(self.ocflpy.list_object_versions("obj"), ["v1", "v2"])
+
+    # New objects are appended to the index log and merged into the index file on shutdown
+    def test_index_log(self):
+        self.ocflpy.shutdown()
+        index_file = os.path.join(self.tmp, "index.json")
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree',
+                             index_file=index_file, start=False)
+        self.ocflpy.build_index()
+        saved = os.stat(index_file).st_mtime_ns
+        for object_id in ["a", "b", "c"]:
+            self.ocflpy.create_object(object_id)
+            self.ocflpy.commit_object(object_id, USER, ADDRESS)
+        self.assertEqual(os.stat(index_file).st_mtime_ns, saved)
+        with open(index_file + ".log") as f:
+            self.assertEqual(len(f.readlines()), 3)
+        self.ocflpy.shutdown()
+        self.assertFalse(os.path.exists(index_file + ".log"))
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree',
+                             index_file=index_file, start=False)
+        self.assertTrue(self.ocflpy.load_index())
+        self.assertEqual(self.ocflpy.list_object_ids(), ["a", "b", "c"])
+
+    # The size of a file includes buffered writes without flushing them
+    def test_stat_buffered_write(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x")
+        fd = self.ocflpy.open_staged_file("obj", "x", os.O_WRONLY)
+        buffer = self.ocflpy.open_write_buffer("obj", fd, "x")
+        try:
+            self.ocflpy.write_buffered(buffer, b"abc", 0)
+            self.ocflpy.write_buffered(buffer, b"def", 3)
+            self.assertEqual(self.ocflpy.stat_staged_path("obj", "x")[1], 6)
+            self.assertEqual(os.fstat(fd).st_size, 0)
+            self.ocflpy.rename_staged_path("obj", "x", "y")
+            self.assertEqual(self.ocflpy.stat_staged_path("obj", "y")[1], 6)
+        finally:
+            self.ocflpy.close_write_buffer(buffer)
+            self.ocflpy.close_staged_file("obj", fd)
+        self.assertEqual(self.ocflpy.stat_staged_path("obj", "y")[1], 6)
+
+    # Commits before the dedup index is loaded or built are recorded in it
+    def test_dedup_index_during_build(self):
+        self.ocflpy.shutdown()
+        dedup_index = os.path.join(self.tmp, "dedup.jsonl")
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree',
+                             dedup_index=dedup_index, start=False)
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x")
+        self.write_file("obj", "x", b"content")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.assertEqual(self.ocflpy.dedup_stats()["entries"], 1)
+        self.ocflpy.init_in_background(False, False)
+        self.ocflpy.shutdown()
+        self.ocflpy = OCFLPY(self.root, os.path.join(self.tmp, "staging"), disposition='pairtree',
+                             dedup_index=dedup_index, start=False)
+        self.assertTrue(self.ocflpy.dedup_index.load())
+        self.assertEqual(self.ocflpy.dedup_stats()["entries"], 1)
+        self.ocflpy.create_object("copy")
+        self.ocflpy.create_staged_file("copy", "y")
+        self.write_file("copy", "y", b"content")
+        self.ocflpy.commit_object("copy", USER, ADDRESS)
+        self.assertEqual(self.ocflpy.dedup_stats()["linked_files"], 1)
+
+    # Truncating keeps the content before the new end
+    def test_truncate_in_place(self):
+        self.ocflpy.create_object("obj")
+        self.ocflpy.create_staged_file("obj", "x")
+        self.write_file("obj", "x", b"hello world")
+        self.ocflpy.commit_object("obj", USER, ADDRESS)
+        self.ocflpy.truncate_staged_file("obj", "x", 5)
+        with open(self.ocflpy.get_read_path("obj", "x"), "rb") as f:
+            self.assertEqual(f.read(), b"hello")
+        self.ocflpy.truncate_staged_file("obj", "x", 0)
+        self.assertEqual(self.ocflpy.stat_staged_path("obj", "x")[1], 0)
+
+    # Copies have the same content and size as sparse source files
+    def test_copy_sparse_file(self):
+        src = os.path.join(self.tmp, "sparse")
+        dst = os.path.join(self.tmp, "copy")
+        with open(src, "wb") as f:
+            f.seek(1024 * 1024)
+            f.write(b"data")
+            f.truncate(4 * 1024 * 1024)
+        copy_file_data(src, dst)
+        with open(src, "rb") as f, open(dst, "rb") as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(os.path.getsize(dst), 4 * 1024 * 1024)
+
+class ShardedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.roots = [os.path.join(self.tmp, "store" + str(i)) for i in range(3)]
+
+    def tearDown(self):
+        self.ocflpy.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def open_store(self, shard_rule="hash", shard_prefixes=None):
+        self.ocflpy = ShardedOCFLPY(self.roots, [os.path.join(self.tmp, "staging")], 'pairtree',
+                                    shard_rule=shard_rule, shard_prefixes=shard_prefixes)
+        self.assertTrue(self.ocflpy.wait_for_index(10))
+
+    # Listings starting at any position of the merged list match the complete list
+    def test_iter_object_ids(self):
+        self.open_store()
+        for i in range(20):
+            self.ocflpy.create_object("obj%02d" % i)
+            self.ocflpy.commit_object("obj%02d" % i, USER, ADDRESS)
+        object_ids = self.ocflpy.list_object_ids()
+        self.assertEqual(object_ids, ["obj%02d" % i for i in range(20)])
+        self.assertTrue(all(shard.count_object_ids() > 0 for shard in self.ocflpy.shards))
+        for start in range(len(object_ids) + 2):
+            self.assertEqual(sum(self.ocflpy.get_shard_positions(start)), min(start, len(object_ids)))
+            self.assertEqual(list(self.ocflpy.iter_object_ids(start, chunk_size=3)), object_ids[start:])
+
+    # New objects go to the root with the longest matching prefix
+    def test_prefix_routing(self):
+        self.open_store("prefix", ["", "a", "ab"])
+        for object_id, shard in [("x", 0), ("ax", 1), ("abc", 2)]:
+            self.assertIs(self.ocflpy.route(object_id), self.ocflpy.shards[shard])
+            self.ocflpy.create_object(object_id)
+            self.ocflpy.commit_object(object_id, USER, ADDRESS)
+            self.assertTrue(self.ocflpy.get_object_path(object_id).startswith(self.roots[shard] + os.sep))
+        self.assertEqual(self.ocflpy.list_object_ids(), ["abc", "ax", "x"])
+        self.ocflpy.shutdown()
+        self.open_store("prefix", ["a", "b", "c"])
+        with self.assertRaises(OCFLException):
+            self.ocflpy.create_object("d")
+
+if __name__ == '__main__':
+    unittest.main()